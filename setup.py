@@ -13,13 +13,15 @@ setup(
     install_requires=[
         "singer-python>=5.1.1, <5.9",
         "requests==2.22.0",
-        "backoff>=1.3.2, <2",
         "ratelimit==2.2.1",
         "pydantic==1.8.2",
     ],
+    extras_require={"aio": ["aiohttp>=3.7, <4"]},
     entry_points="""
           [console_scripts]
           tap-hubspot=tap_hubspot:main
+          tap-hubspot-multi=tap_hubspot.multi:main
+          tap-hubspot-merge-shards=tap_hubspot.shard:main
       """,
     packages=["tap_hubspot"],
     include_package_data=True,
@@ -1,15 +1,40 @@
 #!/usr/bin/env python3
+import argparse
 import shelve
 import os
 import tempfile
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
 import singer
 import sys
 from singer import utils
+from tap_hubspot.cache import (
+    AssociationIndex,
+    FingerprintIndex,
+    PropertyHistoryStore,
+    cache_path,
+    portal_cache_dir,
+)
 from tap_hubspot.stream import Stream
-from tap_hubspot.hubspot import Hubspot, InvalidCredentials, MissingScope
+from tap_hubspot.hubspot import (
+    BudgetExhausted,
+    Hubspot,
+    InvalidCredentials,
+    MissingScope,
+    QuotaExhausted,
+)
 from collections import defaultdict
-from typing import DefaultDict, Set, List
+from typing import DefaultDict, Set, List, Optional
 from tap_hubspot.models import Table
+from tap_hubspot.schedule import (
+    STREAM_DEPENDENCIES,
+    order_tables,
+    record_stream_stats,
+)
+from tap_hubspot.retry import CircuitOpen
+from tap_hubspot.shard import Shard
+from tap_hubspot.transport import log_transport_stats, reset_transport_stats
 
 FREE_STREAMS = [
     Table(
@@ -173,6 +198,21 @@ CUSTOM_STREAMS = [
 ]
 
 
+# streams read through Hubspot.search, which can be split into hs_object_id ranges.
+# contacts_events follows the contacts seen by the same run, so it is sharded too.
+SHARDED_STREAMS = {
+    "companies",
+    "contacts",
+    "deals",
+    "calls",
+    "meetings",
+    "notes",
+    "tasks",
+    "emails",
+    "communications",
+    "contacts_events",
+}
+
 REQUIRED_CONFIG_KEYS = [
     "start_date",
     "client_id",
@@ -184,7 +224,7 @@ REQUIRED_CONFIG_KEYS = [
 LOGGER = singer.get_logger()
 
 
-def sync(config: dict, state=None):
+def sync(config: dict, state=None, session: Optional[requests.Session] = None):
     with tempfile.TemporaryDirectory(
         prefix=f"{os.getcwd()}/temp_event_state_"
     ) as temp_dirname:
@@ -196,37 +236,178 @@ def sync(config: dict, state=None):
         event_state["hs_calculated_form_submissions_guids"] = shelve.open(
             f"{temp_dirname}/hs_calculated_form_submissions_guids"
         )
-        hubspot = Hubspot(config=config, event_state=event_state)
+        started = time.monotonic()
+        hubspot = Hubspot(config=config, event_state=event_state, session=session)
+        # a session handed in may have synced other portals before
+        reset_transport_stats(hubspot.SESSION)
+        if config.get("prewarm", True):
+            portal_id = prewarm(hubspot, config)
+        else:
+            portal_id = hubspot.get_portal_id()
         tables = get_tables(
             advanced_features_enabled=config.get("advanced_features_enabled", False),
-            portal_id=hubspot.get_portal_id(),
+            portal_id=portal_id,
         )
+        cache_dir = portal_cache_dir(config, portal_id)
+        shard = Shard.parse(config["shard"]) if config.get("shard") else None
 
-        for table in tables:
-            try:
-                stream = Stream(
-                    config=config,
-                    tap_stream_id=table.name,
-                    bookmark_key=table.bookmark_key,
-                )
-                if table.should_sync_properties:
-                    LOGGER.info(f"syncing {table.name} properties")
-                    stream.sync_properties(hubspot)
-                LOGGER.info(f"syncing {table.name}")
-                state = stream.do_sync(hubspot, table.is_custom_object, state)
-
-            except InvalidCredentials:
-                LOGGER.exception(f"Invalid credentials")
-                sys.exit(5)
-            except MissingScope as err:
-                LOGGER.exception(err)
-                continue
-            except Exception:
-                LOGGER.exception(f"{table.name} failed")
-                if table.continue_on_error:
-                    LOGGER.warning(f"The {table.name} failed but continuing to next stream")
+        fingerprints = None
+        if cache_dir and config.get("fingerprint_records"):
+            fingerprints = FingerprintIndex(
+                cache_path(cache_dir, "fingerprints", shard),
+                max_entries=config.get("fingerprint_max_entries", 500_000),
+            )
+        if cache_dir and config.get("association_index"):
+            hubspot.association_index = AssociationIndex(
+                cache_path(cache_dir, "associations", shard),
+                max_age_hours=config.get("association_index_max_age_hours", 24),
+            )
+        if cache_dir and config.get("property_history_cache"):
+            hubspot.property_history_store = PropertyHistoryStore(
+                cache_path(cache_dir, "property_history", shard),
+                max_age_hours=config.get("property_history_max_age_hours", 24 * 7),
+            )
+
+
+        if config.get("max_runtime"):
+            hubspot.deadline = started + config["max_runtime"]
+        tables = order_tables(
+            tables,
+            state,
+            by_cost=config.get("order_streams_by_cost", False),
+            starvation_hours=config.get("stream_starvation_hours", 24),
+        )
+        LOGGER.info(f"stream order: {', '.join(table.name for table in tables)}")
+        hubspot.quota.log_projection(
+            (state or {}).get("stream_stats") or {}, [table.name for table in tables]
+        )
+        unfinished: List[str] = []
+        started_streams: Set[str] = set()
+
+        try:
+            for i, table in enumerate(tables):
+                state_key = None
+                if shard:
+                    is_sharded = table.is_custom_object or table.name in SHARDED_STREAMS
+                    if is_sharded:
+                        state_key = shard.state_key(table.name)
+                    elif shard.index != 0:
+                        # streams that can not be split are synced by the first shard only
+                        continue
+                if any(dep in unfinished for dep in STREAM_DEPENDENCIES.get(table.name, [])):
+                    # what it reads from the deferred stream is not there
+                    unfinished.append(table.name)
                     continue
-                sys.exit(1)
+                started_streams.add(table.name)
+                stream_started = time.monotonic()
+                requests_before = hubspot.request_count
+                hubspot.quota.start_stream(table.name)
+                try:
+                    stream = Stream(
+                        config=config,
+                        tap_stream_id=table.name,
+                        bookmark_key=table.bookmark_key,
+                        state_key=state_key,
+                        fingerprints=fingerprints,
+                    )
+                    if table.should_sync_properties and not (shard and shard.index != 0):
+                        LOGGER.info(f"syncing {table.name} properties")
+                        state = stream.sync_properties(hubspot, state)
+                    LOGGER.info(f"syncing {table.name}")
+                    hubspot.check_budget()
+                    state = stream.do_sync(hubspot, table.is_custom_object, state)
+                    state = record_stream_stats(
+                        state,
+                        table.name,
+                        duration=time.monotonic() - stream_started,
+                        requests=hubspot.request_count - requests_before,
+                        records=stream.record_count,
+                    )
+
+                except QuotaExhausted as err:
+                    LOGGER.warning(f"{err}, {table.name} continues in the next run")
+                    unfinished.append(table.name)
+                    continue
+                except CircuitOpen as err:
+                    LOGGER.warning(f"{err} is failing, {table.name} continues in the next run")
+                    unfinished.append(table.name)
+                    continue
+                except BudgetExhausted:
+                    unfinished += [remaining.name for remaining in tables[i:]]
+                    LOGGER.info(
+                        f"max_runtime of {config['max_runtime']}s spent, {len(unfinished)} streams left for the next run"
+                    )
+                    break
+                except InvalidCredentials:
+                    LOGGER.exception(f"Invalid credentials")
+                    sys.exit(5)
+                except MissingScope as err:
+                    LOGGER.exception(err)
+                    continue
+                except Exception:
+                    LOGGER.exception(f"{table.name} failed")
+                    if table.continue_on_error:
+                        LOGGER.warning(f"The {table.name} failed but continuing to next stream")
+                        continue
+                    sys.exit(1)
+            state = state or {}
+            if "contacts_events" in unfinished and "contacts_events" not in started_streams:
+                # the contacts of this run are not in the window of the next one
+                state = Stream(
+                    config=config,
+                    tap_stream_id="contacts_events",
+                    bookmark_key="lastSynced",
+                    state_key=shard.state_key("contacts_events") if shard else None,
+                ).save_pending_contact_ids(state, event_state, completed=False)
+            state.setdefault("bookmarks", {})
+            state["unfinished_streams"] = unfinished
+            singer.write_state(state)
+        finally:
+            hubspot.tokens.close()
+            log_transport_stats(hubspot.SESSION)
+            hubspot.retry.log_metrics()
+            if hubspot.hedger:
+                hubspot.hedger.close()
+            if fingerprints:
+                fingerprints.save()
+            if hubspot.association_index:
+                hubspot.association_index.close()
+            if hubspot.property_history_store:
+                hubspot.property_history_store.close()
+
+        # the changes of streams left for the next run are read again
+        if hubspot.changed_ids and not unfinished:
+            hubspot.changed_ids.mark_processed()
+
+
+def prewarm(hubspot: Hubspot, config: dict) -> Optional[int]:
+    # the requests every run starts with do not depend on each other, so they are
+    # sent at once and the streams find their results cached
+    advanced_features_enabled = config.get("advanced_features_enabled", False)
+    tables = FREE_STREAMS + (ADVANCED_STREAMS if advanced_features_enabled else [])
+    with ThreadPoolExecutor(max_workers=config.get("prewarm_workers", 8)) as executor:
+        portal = executor.submit(hubspot.get_portal_id)
+        probes = [
+            executor.submit(hubspot.get_object_properties, table.name)
+            for table in tables
+            if table.should_sync_properties
+        ]
+        if advanced_features_enabled:
+            probes.append(executor.submit(hubspot.is_enterprise))
+
+        portal_id = portal.result()
+        probes += [
+            executor.submit(hubspot.get_object_properties, table.name)
+            for table in CUSTOM_STREAMS
+            if table.portal_id == portal_id
+        ]
+        for probe in probes:
+            try:
+                probe.result()
+            except Exception as err:
+                # the stream asks again and handles the error where it belongs
+                LOGGER.debug(f"pre-warm request failed: {err}")
+    return portal_id
 
 
 def get_tables(advanced_features_enabled: bool, portal_id: int) -> List[Table]:
@@ -241,9 +422,34 @@ def get_tables(advanced_features_enabled: bool, portal_id: int) -> List[Table]:
     return streams
 
 
+def parse_args():
+    # singer's parser only knows the standard tap arguments, so the tap specific
+    # ones are taken off the command line first and stored in the config
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--shard",
+        help="sync only the i-th of n hs_object_id ranges of the search streams, e.g. 0/4",
+    )
+    parser.add_argument(
+        "--max-runtime",
+        type=int,
+        help="seconds after which streams stop at the next page and the run exits",
+    )
+    tap_args, remaining = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + remaining
+
+    args = utils.parse_args(REQUIRED_CONFIG_KEYS)
+    if tap_args.shard:
+        Shard.parse(tap_args.shard)
+        args.config["shard"] = tap_args.shard
+    if tap_args.max_runtime:
+        args.config["max_runtime"] = tap_args.max_runtime
+    return args
+
+
 @utils.handle_top_exception(LOGGER)
 def main():
-    args = utils.parse_args(REQUIRED_CONFIG_KEYS)
+    args = parse_args()
     sync(args.config, args.state)
 
 
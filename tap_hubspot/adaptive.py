@@ -0,0 +1,44 @@
+import singer
+from singer import metrics
+
+LOGGER = singer.get_logger()
+
+
+class AdaptivePageSize:
+    # Page size of a search that halves after a timeout or server error and grows
+    # back by a quarter when responses come back fast and small.
+    def __init__(
+        self,
+        endpoint: str,
+        maximum: int = 200,
+        minimum: int = 10,
+        fast_seconds: float = 5.0,
+        slow_seconds: float = 60.0,
+        small_bytes: int = 5 * 1024 * 1024,
+    ):
+        self.endpoint = endpoint
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.fast_seconds = fast_seconds
+        self.slow_seconds = slow_seconds
+        self.small_bytes = small_bytes
+        self.size = maximum
+
+    def shrink(self):
+        self.resize(self.size // 2)
+
+    def observe(self, elapsed: float, size_bytes: int):
+        if elapsed >= self.slow_seconds:
+            self.resize(self.size * 3 // 4)
+        elif elapsed < self.fast_seconds and size_bytes < self.small_bytes:
+            self.resize(self.size + max(1, self.size // 4))
+
+    def resize(self, size: int):
+        size = max(self.minimum, min(self.maximum, size))
+        if size == self.size:
+            return
+        self.size = size
+        metrics.log(
+            LOGGER,
+            metrics.Point("gauge", "search_page_size", size, {"endpoint": self.endpoint}),
+        )
@@ -0,0 +1,270 @@
+import asyncio
+import time
+from collections import deque
+from datetime import datetime
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+)
+
+import aiohttp
+import requests
+import simplejson
+import singer
+from requests.structures import CaseInsensitiveDict
+
+from tap_hubspot.hubspot import Hubspot, RetryAfterReauth, raise_for_hubspot_error
+from tap_hubspot.transport import endpoint_template
+
+LOGGER = singer.get_logger()
+
+
+class AsyncRateLimiter:
+    # the asyncio counterpart of ratelimit.limits, waits instead of raising
+    def __init__(self, calls: int = 110, period: float = 10):
+        self.calls = calls
+        self.period = period
+        self.sent: "deque[float]" = deque()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.sent and now - self.sent[0] >= self.period:
+                    self.sent.popleft()
+                if len(self.sent) < self.calls:
+                    self.sent.append(now)
+                    return
+                await asyncio.sleep(self.period - (now - self.sent[0]))
+
+
+class AsyncResponse:
+    # the parts of a response the tap reads, available after the connection is released
+    def __init__(self, status_code: int, headers: Mapping[str, str], text: str, url: str):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+        self.url = url
+
+    def json(self) -> Any:
+        return simplejson.loads(self.text)
+
+
+def encode_params(params: Optional[Dict]) -> List:
+    # aiohttp only accepts strings, lists are sent as repeated parameters like requests does
+    encoded = []
+    for key, value in (params or {}).items():
+        if value is None:
+            continue
+        values = value if isinstance(value, (list, tuple)) else [value]
+        encoded.extend((key, str(v)) for v in values)
+    return encoded
+
+
+class AsyncHubspot:
+    # Sends the requests of a Hubspot client from an asyncio event loop, so many
+    # requests can be in flight without a thread each. Configuration, tokens and
+    # the shard bounds are shared with the wrapped client.
+    def __init__(self, hubspot: Hubspot, concurrency: Optional[int] = None):
+        self.hubspot = hubspot
+        self.concurrency = concurrency or hubspot.config.get("async_concurrency", 20)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.rate_limiter = AsyncRateLimiter()
+        self.token_lock = asyncio.Lock()
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> "AsyncHubspot":
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(sock_read=self.hubspot.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def ensure_access_token(self):
+        # one refresh at a time, the others find the new token once it is done
+        async with self.token_lock:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.hubspot.ensure_access_token
+            )
+
+    async def do(
+        self,
+        method: str,
+        url: str,
+        data: Optional[Any] = None,
+        json: Optional[Any] = None,
+        params: Optional[Any] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> AsyncResponse:
+        # retried, paused by the circuit breakers and counted against the quota
+        # like Hubspot.do
+        return await self.hubspot.retry.call_async(
+            endpoint_template(url),
+            lambda: self.do_once(method, url, data, json, params, headers),
+        )
+
+    async def do_once(
+        self,
+        method: str,
+        url: str,
+        data: Optional[Any] = None,
+        json: Optional[Any] = None,
+        params: Optional[Any] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> AsyncResponse:
+        url = f"{self.hubspot.BASE_URL}{url}"
+        await self.ensure_access_token()
+        access_token = self.hubspot.access_token
+        headers = {**(headers or {}), "Authorization": f"Bearer {access_token}"}
+
+        async with self.semaphore:
+            await self.rate_limiter.acquire()
+            self.hubspot.request_count += 1
+            try:
+                async with self.session.request(
+                    method,
+                    url,
+                    headers=headers,
+                    params=encode_params(params),
+                    json=json,
+                    data=data,
+                ) as response:
+                    resp = AsyncResponse(
+                        response.status,
+                        CaseInsensitiveDict(response.headers),
+                        await response.text(),
+                        str(response.url),
+                    )
+            # the retry policy and its giveup decisions know the errors of requests
+            except asyncio.TimeoutError as err:
+                raise requests.Timeout(err) from err
+            except aiohttp.ClientConnectionError as err:
+                raise requests.ConnectionError(err) from err
+            except aiohttp.ClientError as err:
+                raise requests.RequestException(err) from err
+
+        self.hubspot.quota.observe(resp.headers)
+        try:
+            raise_for_hubspot_error(resp.status_code, resp.text, resp)
+        except RetryAfterReauth:
+            # the retry gets a new token, as in Hubspot.do
+            self.hubspot.tokens.invalidate(access_token)
+            raise
+
+        LOGGER.debug(resp.url)
+        if resp.status_code >= 400:
+            raise requests.HTTPError(
+                f"{resp.status_code} Error for url: {resp.url}", response=resp
+            )
+        return resp
+
+    async def paginate(
+        self,
+        path: str,
+        params: Dict = None,
+        data_field: str = None,
+        offset_key=None,
+    ) -> AsyncIterator[Any]:
+        params = dict(params or {})
+        while True:
+            resp = await self.do("GET", path, params=params)
+            data = resp.json()
+
+            if not data_field:
+                # non paginated list
+                for record in data:
+                    yield record
+                return
+
+            records = data.get(data_field, [])
+            if not records:
+                return
+            for record in records:
+                yield record
+
+            offset_value = self.hubspot.next_offset(data, offset_key)
+            if not offset_value:
+                return
+            params[offset_key] = offset_value
+
+    async def search(
+        self,
+        object_type: str,
+        filter_key: str,
+        start_date: datetime,
+        end_date: datetime,
+        properties: List[str],
+        primary_key: str,
+        limit=200,
+    ) -> AsyncIterator[Dict]:
+        path = f"/crm/v3/objects/{object_type}/search"
+        after = 0
+        primary_key_value = "0"
+        primary_key_max = None
+        if self.hubspot.shard:
+            lower, upper = await asyncio.get_running_loop().run_in_executor(
+                None, self.hubspot.get_shard_bounds, object_type, primary_key
+            )
+            primary_key_value = str(lower)
+            primary_key_max = str(upper) if upper is not None else None
+
+        while True:
+            body = self.hubspot.build_search_body(
+                start_date,
+                end_date,
+                properties,
+                filter_key,
+                after,
+                primary_key,
+                primary_key_value,
+                limit=limit,
+                primary_key_max=primary_key_max,
+            )
+            resp = await self.do("POST", path, json=body)
+            data = resp.json()
+
+            records = data.get("results", [])
+            if not records:
+                return
+            for record in records:
+                yield record
+
+            page_after = data.get("paging", {}).get("next", {}).get("after", None)
+            if page_after is None:
+                return
+
+            # searches stop at 10,000 results, continue after the last primary key
+            if int(page_after) >= 10000:
+                after = 0
+                primary_key_value = self.hubspot.get_value(
+                    records[-1], ["properties", primary_key]
+                )
+                continue
+
+            after = int(page_after)
+
+
+async def fan_out(
+    items: Iterable[Any],
+    fetch: Callable[[Any], Awaitable[Any]],
+) -> AsyncIterator[Any]:
+    # runs fetch for every item concurrently and yields the results in the order
+    # they complete, the client's semaphore bounds how many requests are in flight
+    tasks = [asyncio.ensure_future(fetch(item)) for item in items]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
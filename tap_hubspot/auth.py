@@ -0,0 +1,168 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+import requests
+import singer
+
+LOGGER = singer.get_logger()
+
+TOKEN_URL = "https://api.hubapi.com/oauth/v1/token"
+
+
+class InvalidCredentials(Exception):
+    pass
+
+
+class TokenManager:
+    # Hands out the access token of one client/refresh token pair. Concurrent
+    # callers share a single refresh, the token is refreshed in the background
+    # before it expires, and it is cached on disk so other processes using the
+    # same credentials skip the token exchange until it expires. Processes refresh
+    # under a file lock and take a token another process refreshed meanwhile.
+    def __init__(
+        self,
+        config: Dict,
+        session: requests.Session,
+        cache_dir: Optional[str] = None,
+        margin_seconds: int = 5 * 60,
+    ):
+        self.config = config
+        self.session = session
+        self.cache_path = self.token_cache_path(config, cache_dir)
+        # tokens are used until margin_seconds before they expire
+        self.margin_seconds = margin_seconds
+        self.access_token: Optional[str] = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+        self.timer: Optional[threading.Timer] = None
+
+    @staticmethod
+    def token_cache_path(config: Dict, cache_dir: Optional[str]) -> Optional[str]:
+        if not cache_dir:
+            return None
+        key = hashlib.sha256(
+            f"{config['client_id']}\x00{config['refresh_token']}".encode()
+        ).hexdigest()[:32]
+        os.makedirs(os.path.join(cache_dir, "tokens"), exist_ok=True)
+        return os.path.join(cache_dir, "tokens", f"{key}.json")
+
+    def is_valid(self) -> bool:
+        return (
+            self.access_token is not None
+            and time.time() < self.expires_at - self.margin_seconds
+        )
+
+    def get(self) -> str:
+        if self.is_valid():
+            return self.access_token
+        with self.lock:
+            # another thread may have refreshed while this one was waiting
+            if not self.is_valid() and not self.load():
+                with self.file_lock():
+                    if not self.load():
+                        self.refresh()
+            return self.access_token
+
+    @contextmanager
+    def file_lock(self) -> Iterator[None]:
+        if not self.cache_path:
+            yield
+            return
+        with open(f"{self.cache_path}.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self, newer_than: float = 0.0) -> bool:
+        # takes the cached token when it is valid and expires after newer_than
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            LOGGER.warning(f"ignoring unreadable token cache {self.cache_path}")
+            return False
+        if cached["expires_at"] <= newer_than:
+            return False
+        self.access_token = cached["access_token"]
+        self.expires_at = cached["expires_at"]
+        if not self.is_valid():
+            return False
+        self.schedule_refresh()
+        return True
+
+    def save(self):
+        if not self.cache_path:
+            return
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        # the token grants access to the portal, only the owner may read it
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {"access_token": self.access_token, "expires_at": self.expires_at}, f
+            )
+        os.replace(tmp_path, self.cache_path)
+
+    def refresh(self):
+        payload = {
+            "grant_type": "refresh_token",
+            "refresh_token": self.config["refresh_token"],
+            "client_id": self.config["client_id"],
+            "client_secret": self.config["client_secret"],
+        }
+
+        resp = self.session.post(TOKEN_URL, data=payload, timeout=60)
+        if resp.status_code == 403:
+            raise InvalidCredentials(resp.text)
+        resp.raise_for_status()
+
+        data = resp.json()
+
+        # expires_in is 1800 seconds by default
+        self.access_token = data["access_token"]
+        self.expires_at = time.time() + data["expires_in"]
+        self.save()
+        self.schedule_refresh()
+
+    def schedule_refresh(self):
+        # refresh before callers would have to, so they never wait for it
+        if self.timer:
+            self.timer.cancel()
+        delay = max(0, self.expires_at - self.margin_seconds * 1.5 - time.time())
+        self.timer = threading.Timer(delay, self.refresh_in_background)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def refresh_in_background(self):
+        try:
+            with self.lock, self.file_lock():
+                # all processes sharing the token schedule this at the same time,
+                # the first one refreshes and the others read its token
+                if not self.load(newer_than=self.expires_at):
+                    self.refresh()
+        except Exception as err:
+            # the next caller refreshes in the foreground once the token expires
+            LOGGER.warning(f"background token refresh failed: {err}")
+
+    def invalidate(self, access_token: str):
+        # drops a token hubspot rejected, unless it was replaced in the meantime
+        with self.lock:
+            if self.access_token != access_token:
+                return
+            self.access_token = None
+            self.expires_at = 0.0
+            if self.cache_path and os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
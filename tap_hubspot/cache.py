@@ -0,0 +1,291 @@
+import hashlib
+import json
+import os
+import shelve
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import singer
+from dateutil import parser
+
+LOGGER = singer.get_logger()
+
+# keys that identify a record across runs, in order of preference
+RECORD_ID_KEYS = ("id", "guid", "objectId", "listId")
+
+# properties hubspot updates when associations of an object are added or removed,
+# e.g. num_associated_contacts on deals
+ASSOCIATION_SIGNAL_PREFIXES = ("num_associated_", "hs_num_associated_")
+
+
+def portal_cache_dir(config: Dict, portal_id: Optional[int]) -> Optional[str]:
+    # everything the tap keeps between runs lives in one directory per portal
+    cache_dir = config.get("cache_dir")
+    if not cache_dir or not portal_id:
+        return None
+    path = os.path.join(cache_dir, str(portal_id))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cache_path(cache_dir: str, name: str, shard: Optional[Any] = None) -> str:
+    # shards of a portal running on the same host each keep their own files
+    if shard:
+        name = f"{name}-shard{shard.index}of{shard.count}"
+    return os.path.join(cache_dir, name)
+
+
+def record_id(record: Dict) -> Optional[str]:
+    for key in RECORD_ID_KEYS:
+        value = record.get(key)
+        if value is not None:
+            return str(value)
+    return None
+
+
+class FingerprintIndex:
+    # Maps (stream, record id) to a hash of the last emitted version of the record.
+    # Both are stored as 8 byte blake2b digests, so the file is a header followed
+    # by fixed 16 byte entries, least recently seen first. When the index is full
+    # the least recently seen entries are evicted. Every entry costs about 200
+    # bytes of memory while the index is loaded.
+    MAGIC = b"THFP1\n"
+    DIGEST_SIZE = 8
+    ENTRY_SIZE = 2 * DIGEST_SIZE
+
+    def __init__(self, path: str, max_entries: int = 500_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[bytes, bytes]" = OrderedDict()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            data = f.read()
+        if not data.startswith(self.MAGIC):
+            LOGGER.warning(f"ignoring fingerprint index with unknown format: {self.path}")
+            return
+        view = memoryview(data)[len(self.MAGIC) :]
+        for offset in range(0, len(view) - self.ENTRY_SIZE + 1, self.ENTRY_SIZE):
+            key = bytes(view[offset : offset + self.DIGEST_SIZE])
+            self.entries[key] = bytes(
+                view[offset + self.DIGEST_SIZE : offset + self.ENTRY_SIZE]
+            )
+        LOGGER.info(f"loaded {len(self.entries)} record fingerprints")
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(b"".join(key + digest for key, digest in self.entries.items()))
+        os.replace(tmp_path, self.path)
+
+    def digest(self, data: bytes) -> bytes:
+        return hashlib.blake2b(data, digest_size=self.DIGEST_SIZE).digest()
+
+    def fingerprint(self, stream: str, record: Dict) -> Optional[Tuple[bytes, bytes]]:
+        # the key and fingerprint of a record, None for records without an id
+        id = record_id(record)
+        if id is None:
+            return None
+        key = self.digest(f"{stream}\x00{id}".encode())
+        content = json.dumps(record, sort_keys=True, default=str).encode()
+        return key, self.digest(content)
+
+    def is_unchanged(self, entry: Tuple[bytes, bytes]) -> bool:
+        key, fingerprint = entry
+        return self.entries.get(key) == fingerprint
+
+    def remember(self, entry: Tuple[bytes, bytes]):
+        # only once the record is written, a record lost in between is emitted again
+        key, fingerprint = entry
+        self.entries[key] = fingerprint
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+def association_signal(record: Dict) -> Tuple[Tuple[str, Any], ...]:
+    properties = record.get("properties") or {}
+    return tuple(
+        sorted(
+            (name, value)
+            for name, value in properties.items()
+            if name.startswith(ASSOCIATION_SIGNAL_PREFIXES)
+        )
+    )
+
+
+class AssociationIndex:
+    # Keeps the last known associations of every object together with the
+    # association counters of the record they were read for. Associations are
+    # read again when the counters changed, or once the entry is older than
+    # max_age_hours, which reconciles changes no counter follows. Entries that
+    # old are evicted when the index is closed. Objects without counters are not
+    # kept, nothing would tell when their associations change.
+    def __init__(self, path: str, max_age_hours: float = 24):
+        self.db = shelve.open(path)
+        self.max_age = max_age_hours * 60 * 60
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(
+        self,
+        from_obj: str,
+        to_obj: str,
+        records: List[Dict],
+        fetch: Callable[[List[str]], Dict[str, List[Any]]],
+    ) -> Dict[str, List[Any]]:
+        now = time.time()
+        result: Dict[str, List[Any]] = {}
+        stale: Dict[str, Tuple] = {}
+        uncached: List[str] = []
+        for record in records:
+            id = record["id"]
+            signal = association_signal(record)
+            if not signal:
+                uncached.append(id)
+                continue
+            entry = self.db.get(f"{from_obj}:{to_obj}:{id}")
+            if self.is_current(entry, signal, now):
+                result[id] = entry[2]
+            else:
+                stale[id] = signal
+
+        self.hits += len(result)
+        self.misses += len(stale) + len(uncached)
+        if not stale and not uncached:
+            return result
+
+        fetched = fetch(list(stale) + uncached)
+        for id, signal in stale.items():
+            associations = fetched.get(id, [])
+            self.db[f"{from_obj}:{to_obj}:{id}"] = (signal, now, associations)
+            result[id] = associations
+        for id in uncached:
+            result[id] = fetched.get(id, [])
+        return result
+
+    def is_current(self, entry: Optional[Tuple], signal: Tuple, now: float) -> bool:
+        return bool(entry) and entry[0] == signal and now - entry[1] < self.max_age
+
+    def evict(self):
+        now = time.time()
+        expired = [key for key, entry in self.db.items() if now - entry[1] >= self.max_age]
+        for key in expired:
+            del self.db[key]
+        if expired:
+            LOGGER.info(f"evicted {len(expired)} expired entries from the association index")
+
+    def close(self):
+        LOGGER.info(
+            f"association index served {self.hits} objects, read {self.misses} from hubspot"
+        )
+        self.evict()
+        self.db.close()
+
+
+def history_timestamp(entry: Dict) -> float:
+    # timestamps come with varying fractional second precision, so they are only
+    # comparable once parsed
+    timestamp = entry.get("timestamp")
+    if not timestamp:
+        return 0
+    return parser.isoparse(timestamp).timestamp()
+
+
+def merge_history(cached: List[Dict], fetched: List[Dict]) -> List[Dict]:
+    # history entries are listed newest first, entries already known are kept once
+    seen = set()
+    merged = []
+    for entry in fetched + cached:
+        key = (history_timestamp(entry), entry.get("value"), entry.get("sourceId"))
+        if key in seen:
+            continue
+        seen.add(key)
+        merged.append(entry)
+    merged.sort(key=history_timestamp, reverse=True)
+    return merged
+
+
+def history_signal(record: Dict, properties: List[str]) -> Dict[str, Tuple[Any, Any]]:
+    # the current value of every property, and when the deal entered its current
+    # stage. Leaving a stage and coming back keeps the value but moves the date.
+    current = record.get("properties") or {}
+    signal = {}
+    for name in properties:
+        value = current.get(name)
+        entered = None
+        if name == "dealstage":
+            entered = current.get("hs_v2_date_entered_current_stage") or current.get(
+                f"hs_date_entered_{value}"
+            )
+        signal[name] = (value, entered)
+    return signal
+
+
+class PropertyHistoryStore:
+    # Keeps the property history of every object. An object's history is read
+    # again when one of the properties changed since, as told by history_signal,
+    # or once the entry is older than max_age_hours, which catches the changes the
+    # signal misses, e.g. a property other than dealstage that changed and
+    # changed back.
+    def __init__(self, path: str, max_age_hours: float = 24 * 7):
+        self.db = shelve.open(path)
+        self.max_age = max_age_hours * 60 * 60
+        self.hits = 0
+        self.misses = 0
+
+    def is_current(self, entry: Optional[Dict], record: Dict, properties: List[str]):
+        if not entry or time.time() - entry["fetched_at"] >= self.max_age:
+            return False
+        if any(name not in entry["history"] for name in properties):
+            return False
+        return entry.get("signal") == history_signal(record, properties)
+
+    def lookup(
+        self,
+        obj_type: str,
+        properties: List[str],
+        records: List[Dict],
+        fetch: Callable[[List[str]], Dict[str, Dict[str, List[Dict]]]],
+    ) -> Dict[str, Dict[str, List[Dict]]]:
+        result: Dict[str, Dict[str, List[Dict]]] = {}
+        stale: Dict[str, Optional[Dict]] = {}
+        for record in records:
+            id = record["id"]
+            entry = self.db.get(f"{obj_type}:{id}")
+            if self.is_current(entry, record, properties):
+                result[id] = {name: entry["history"][name] for name in properties}
+            else:
+                stale[id] = entry
+
+        self.hits += len(result)
+        self.misses += len(stale)
+        if not stale:
+            return result
+
+        fetched = fetch(list(stale))
+        now = time.time()
+        signals = {record["id"]: history_signal(record, properties) for record in records}
+        for id, entry in stale.items():
+            history = dict(entry["history"]) if entry else {}
+            for name, entries in fetched.get(id, {}).items():
+                history[name] = merge_history(history.get(name, []), entries)
+            self.db[f"{obj_type}:{id}"] = {
+                "fetched_at": now,
+                "signal": signals[id],
+                "history": history,
+            }
+            result[id] = {name: history[name] for name in properties if name in history}
+        return result
+
+    def close(self):
+        LOGGER.info(
+            f"property history store served {self.hits} objects, read {self.misses} from hubspot"
+        )
+        self.db.close()
+
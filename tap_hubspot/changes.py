@@ -0,0 +1,136 @@
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+import singer
+
+LOGGER = singer.get_logger()
+
+# object type ids used by the generic object.* webhook subscriptions
+OBJECT_TYPE_IDS = {
+    "0-1": "contacts",
+    "0-2": "companies",
+    "0-3": "deals",
+    "0-5": "tickets",
+    "0-18": "communications",
+    "0-27": "tasks",
+    "0-46": "notes",
+    "0-47": "meetings",
+    "0-48": "calls",
+    "0-49": "emails",
+}
+
+# prefixes of the legacy per object webhook subscriptions, e.g. contact.propertyChange
+SUBSCRIPTION_OBJECT_TYPES = {
+    "contact": "contacts",
+    "company": "companies",
+    "deal": "deals",
+    "ticket": "tickets",
+}
+
+PROCESSED_SUFFIX = ".processed"
+# files are renamed before they are read, so lines appended during the run go to a
+# new file and are left for the next run. Every snapshot gets its own name, a run
+# after a failed one must not replace the snapshot that was not read.
+SNAPSHOT_SUFFIX = ".reading"
+
+
+def snapshot_path(path: str) -> str:
+    return f"{path}.{time.time_ns()}.{os.getpid()}{SNAPSHOT_SUFFIX}"
+
+
+class ChangedIds:
+    # Reads the ids of changed objects from a file, or a directory of files, with
+    # one JSON document per line. A line is either a HubSpot webhook event, a list
+    # of them as delivered in one webhook request, or {"objectType": "contacts",
+    # "objectId": 123} for producers other than webhooks. Producers have to open
+    # the file for every write, or write new files.
+    def __init__(self, path: str):
+        self.path = path
+        self.files: List[str] = []
+        self.ids_by_type: Optional[Dict[str, Dict[str, None]]] = None
+
+    @staticmethod
+    def list_files(path: str) -> List[str]:
+        # snapshots left by a run that failed are read again
+        if not os.path.isdir(path):
+            directory = os.path.dirname(path) or "."
+            prefix = os.path.basename(path) + "."
+            snapshots = sorted(
+                os.path.join(directory, name)
+                for name in os.listdir(directory)
+                if name.startswith(prefix) and name.endswith(SNAPSHOT_SUFFIX)
+            )
+            return snapshots + ([path] if os.path.exists(path) else [])
+        # the snapshots hold the older changes
+        return sorted(
+            (
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if not name.endswith(PROCESSED_SUFFIX)
+                and os.path.isfile(os.path.join(path, name))
+            ),
+            key=lambda name: (not name.endswith(SNAPSHOT_SUFFIX), name),
+        )
+
+    def snapshot(self) -> List[str]:
+        files: Dict[str, None] = {}
+        for path in self.list_files(self.path):
+            if not path.endswith(SNAPSHOT_SUFFIX):
+                snapshot = snapshot_path(path)
+                os.replace(path, snapshot)
+                path = snapshot
+            files[path] = None
+        return list(files)
+
+    def ids(self, object_type: str) -> List[str]:
+        if self.ids_by_type is None:
+            self.ids_by_type = self.load()
+        return list(self.ids_by_type.get(object_type, {}))
+
+    def load(self) -> Dict[str, Dict[str, None]]:
+        # dicts keep the order the changes arrived in and drop repeated ids
+        ids_by_type: Dict[str, Dict[str, None]] = {}
+        self.files = self.snapshot()
+        for path in self.files:
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    for event in self.parse_line(line):
+                        object_type = self.object_type(event)
+                        object_id = event.get("objectId")
+                        if not object_type or object_id is None:
+                            continue
+                        ids_by_type.setdefault(object_type, {})[str(object_id)] = None
+
+        for object_type, ids in ids_by_type.items():
+            LOGGER.info(f"found {len(ids)} changed {object_type}")
+        return ids_by_type
+
+    @staticmethod
+    def parse_line(line: str) -> Iterable[Dict]:
+        data = json.loads(line)
+        if isinstance(data, list):
+            return data
+        return [data]
+
+    @staticmethod
+    def object_type(event: Dict) -> Optional[str]:
+        if event.get("objectType"):
+            return event["objectType"]
+
+        subscription_type: str = event.get("subscriptionType", "")
+        # deleted objects can not be read anymore, the archived_* streams pick them up
+        if subscription_type.endswith(".deletion"):
+            return None
+        if event.get("objectTypeId"):
+            return OBJECT_TYPE_IDS.get(event["objectTypeId"])
+        return SUBSCRIPTION_OBJECT_TYPES.get(subscription_type.split(".", 1)[0])
+
+    def mark_processed(self):
+        for path in self.files:
+            os.replace(path, path[: -len(SNAPSHOT_SUFFIX)] + PROCESSED_SUFFIX)
+        self.files = []
@@ -0,0 +1,89 @@
+import csv
+import io
+import zipfile
+from datetime import datetime, timezone
+from typing import IO, Dict, Iterable, Optional
+
+# CRM exports return one column per property, named by its internal name when
+# requested with the NAMES option. The object id is in its own column.
+ID_COLUMNS = ["hs_object_id", "Record ID"]
+
+# export object types of the standard objects, custom objects use their own type
+EXPORT_OBJECT_TYPES = {
+    "contacts": "CONTACT",
+    "companies": "COMPANY",
+    "deals": "DEAL",
+}
+
+# exported cells can hold some values larger than csv's default field limit
+csv.field_size_limit(2**31 - 1)
+
+
+def export_object_type(obj_type: str) -> str:
+    return EXPORT_OBJECT_TYPES.get(obj_type, obj_type)
+
+
+def normalize_datetime(value: Optional[str], property_type: str = "datetime") -> Optional[str]:
+    # datetimes and dates can be exported as epoch milliseconds, search returns
+    # them as iso datetimes and iso dates
+    if not value or not value.lstrip("-").isdigit():
+        return value
+    timestamp = datetime.fromtimestamp(int(value) / 1000, timezone.utc)
+    if property_type == "date":
+        return timestamp.strftime("%Y-%m-%d")
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def export_files(fileobj: IO[bytes]) -> Iterable[IO[bytes]]:
+    # large exports are delivered as a zip archive with one csv per part
+    if zipfile.is_zipfile(fileobj):
+        with zipfile.ZipFile(fileobj) as archive:
+            for name in sorted(archive.namelist()):
+                if not name.lower().endswith(".csv"):
+                    continue
+                with archive.open(name) as member:
+                    yield member
+        return
+    fileobj.seek(0)
+    yield fileobj
+
+
+def parse_export(
+    fileobj: IO[bytes], property_types: Dict[str, str]
+) -> Iterable[Dict]:
+    # property_types maps property names to their type in /crm/v3/properties
+    datetime_properties = {
+        name: property_type
+        for name, property_type in property_types.items()
+        if property_type in ("datetime", "date")
+    }
+    for part in export_files(fileobj):
+        reader = csv.DictReader(io.TextIOWrapper(part, encoding="utf-8-sig"))
+        for row in reader:
+            yield to_search_record(row, datetime_properties)
+
+
+def to_search_record(row: Dict[str, str], datetime_properties: Dict[str, str]) -> Dict:
+    # mirror the shape of a record returned by the search endpoint
+    properties: Dict[str, Optional[str]] = {}
+    for name, value in row.items():
+        if name == "Record ID":
+            continue
+        properties[name] = value if value != "" else None
+
+    for name, property_type in datetime_properties.items():
+        if name in properties:
+            properties[name] = normalize_datetime(properties[name], property_type)
+
+    record_id = next((row[column] for column in ID_COLUMNS if row.get(column)), None)
+    if record_id is None:
+        raise ValueError(f"export row has none of the id columns {ID_COLUMNS}")
+    properties["hs_object_id"] = record_id
+    return {
+        "id": record_id,
+        "properties": properties,
+        "createdAt": properties.get("createdate") or properties.get("hs_createdate"),
+        "updatedAt": properties.get("hs_lastmodifieddate")
+        or properties.get("lastmodifieddate"),
+        "archived": False,
+    }
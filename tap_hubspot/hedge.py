@@ -0,0 +1,101 @@
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, Optional
+
+import ratelimit
+import requests
+import singer
+
+LOGGER = singer.get_logger()
+
+
+class LatencyTracker:
+    # the latencies of the last window requests per endpoint template
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self.latencies: Dict[str, Deque[float]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, template: str, seconds: float):
+        with self.lock:
+            latencies = self.latencies.setdefault(template, deque(maxlen=self.window))
+            latencies.append(seconds)
+
+    def percentile(self, template: str, percentile: float) -> Optional[float]:
+        with self.lock:
+            latencies = sorted(self.latencies.get(template, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+
+class Hedger:
+    # Sends a second copy of an idempotent request that is slower than the
+    # given percentile of its endpoint and uses whichever response arrives
+    # first. At most max_fraction of all requests are hedges, and every hedge
+    # is counted like any other request by count_call.
+    def __init__(
+        self,
+        count_call: Callable[[], None],
+        percentile: float = 95,
+        max_fraction: float = 0.05,
+        min_delay: float = 1.0,
+    ):
+        self.count_call = count_call
+        self.percentile = percentile
+        self.max_fraction = max_fraction
+        self.min_delay = min_delay
+        self.latencies = LatencyTracker()
+        self.executor = ThreadPoolExecutor(thread_name_prefix="hedge")
+        self.requests = 0
+        self.hedges = 0
+        self.hedges_won = 0
+
+    def budget_left(self) -> bool:
+        return self.hedges < self.requests * self.max_fraction
+
+    def request(
+        self, template: str, send: Callable[[], requests.Response]
+    ) -> requests.Response:
+        self.requests += 1
+        delay = self.latencies.percentile(template, self.percentile)
+        if delay is None:
+            return send()
+
+        primary = self.executor.submit(send)
+        done, _ = wait([primary], timeout=max(delay, self.min_delay))
+        if done or not self.budget_left():
+            return primary.result()
+        try:
+            self.count_call()
+        except ratelimit.RateLimitException:
+            return primary.result()
+
+        self.hedges += 1
+        LOGGER.debug(f"hedging {template} after {delay:.1f}s")
+        hedge = self.executor.submit(send)
+        pending = {primary, hedge}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.hedges_won += 1
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def log_stats(self):
+        if self.hedges:
+            LOGGER.info(
+                f"hedged {self.hedges} of {self.requests} requests, {self.hedges_won} hedges answered first"
+            )
+
+    def close(self):
+        self.log_stats()
+        # hedges that lost their race finish in the background
+        self.executor.shutdown(wait=False)
@@ -1,17 +1,35 @@
 import requests
 import sys
+import random
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from ratelimit import limits
-import ratelimit
 import singer
-import backoff
 from datetime import datetime, timezone, timedelta
-from typing import Dict, Iterable, Optional, DefaultDict, Set, List, Any, Tuple, TypeVar
+from typing import TYPE_CHECKING, Deque, Dict, Iterable, Optional, DefaultDict, Set, List, Any, Tuple, TypeVar
 
 from dateutil import parser
 import simplejson
 import json
 
-from tap_hubspot.models import EventSettings
+from tap_hubspot.adaptive import AdaptivePageSize
+from tap_hubspot.auth import InvalidCredentials, TokenManager
+from tap_hubspot.cache import AssociationIndex, PropertyHistoryStore
+from tap_hubspot.changes import ChangedIds
+from tap_hubspot.export import export_object_type, parse_export
+from tap_hubspot.hedge import Hedger
+from tap_hubspot.memo import ResponseMemo
+from tap_hubspot.quota import DailyQuota
+from tap_hubspot.raw import decode_response
+from tap_hubspot.retry import CircuitBreaker, CircuitOpen, RetryPolicy
+from tap_hubspot.shard import Shard, round_max_id
+from tap_hubspot.slices import Slice, is_covered, time_slices
+from tap_hubspot.transport import create_session, endpoint_template, endpoint_timeout
+
+if TYPE_CHECKING:
+    from tap_hubspot.event_settings import EventSettings
 
 
 class RetryAfterReauth(Exception):
@@ -24,14 +42,74 @@ class BadRequest(Exception):
         self.response = response
 
 
-class InvalidCredentials(Exception):
+class MissingScope(Exception):
     pass
 
 
-class MissingScope(Exception):
+class NotModified(Exception):
+    pass
+
+
+class BudgetExhausted(Exception):
+    # the run's max_runtime is spent, raised before the next page is requested
+    pass
+
+
+class QuotaExhausted(BudgetExhausted):
+    # the daily request quota is too low for the current stream, later streams may still run
     pass
 
 
+class TransientError(Exception):
+    # a timeout or server error handed to the caller instead of being retried
+    def __init__(self, cause: requests.RequestException):
+        super().__init__(str(cause))
+        self.cause = cause
+        self.status_code = (
+            cause.response.status_code if isinstance(cause, requests.HTTPError) else None
+        )
+
+
+def is_transient(e: Exception) -> bool:
+    if isinstance(e, requests.Timeout):
+        return True
+    return isinstance(e, requests.HTTPError) and e.response.status_code >= 500
+
+
+def raise_for_hubspot_error(status_code: int, text: str, response=None):
+    # maps error responses to the exceptions of the tap, shared by Hubspot.do and
+    # the asyncio client
+    if status_code == 401:
+        raise RetryAfterReauth
+
+    if status_code == 403:
+        err_msg: Dict = simplejson.loads(text)
+
+        # if there is no category, the error message is a legacy error message, and might have another
+        # format. https://legacydocs.hubspot.com/docs/faq/api-error-responses
+        if err_msg.get("category") is None:
+            if "You do not have permissions to view object type" in err_msg.get(
+                "message"
+            ):
+                raise MissingScope(err_msg)
+        if err_msg.get("category") == "MISSING_SCOPES":
+            raise MissingScope(err_msg)
+
+    if status_code == 400:
+        raise BadRequest(f"Bad Request: {text}", response=response)
+
+
+def is_idempotent(method: str, url: str) -> bool:
+    # searches and batch reads are POSTs that only read
+    return method == "GET" or (
+        method == "POST" and ("/search" in url or "/batch/read" in url)
+    )
+
+
+# client errors that are not retried
+GIVEUP_STATUS_CODES = {400, 403, 404}
+
+
 def giveup_http_codes(e: Exception):
     if not isinstance(e, requests.RequestException):
         return False
@@ -39,7 +117,7 @@ def giveup_http_codes(e: Exception):
     if isinstance(e, requests.HTTPError):
         # raised by response.raise_for_status()
         status_code = e.response.status_code
-        if status_code in {400, 403, 404}:
+        if status_code in GIVEUP_STATUS_CODES:
             return True
 
     if isinstance(e, (requests.Timeout, requests.ConnectionError)):
@@ -59,6 +137,21 @@ DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
 
 T = TypeVar("T")
 
+# shared by every request of the process, hedged requests included
+RATE_LIMIT = limits(calls=110, period=10)
+# counts a request that is sent outside of Hubspot.do against RATE_LIMIT
+count_rate_limited_call = RATE_LIMIT(lambda: None)
+
+# maximum number of inputs of the v4 associations batch read endpoint
+ASSOCIATIONS_BATCH_SIZE = 1000
+# batch reads that include propertiesWithHistory accept at most 50 inputs
+PROPERTY_HISTORY_BATCH_SIZE = 50
+# maximum number of inputs of the v3 objects batch read endpoint
+BATCH_READ_SIZE = 100
+
+# contact properties hubspot populates some time after the contact is created
+TRACKING_PROPERTIES = ["hs_analytics_source", "hs_analytics_first_timestamp"]
+
 
 def chunker(iter: Iterable[T], size: int) -> Iterable[List[T]]:
     i = 0
@@ -81,14 +174,76 @@ class Hubspot:
         event_state: DefaultDict[Set, str],
         limit=250,
         timeout=3 * 60,  # seconds before first byte should have been received
+        session: Optional[requests.Session] = None,
     ):
-        self.SESSION = requests.Session()
+        # a session can be handed in to reuse warm connections across portals
+        self.SESSION = session or create_session(config)
         self.limit = limit
         self.access_token = None
-        self.access_token_ttl = None
+        self.tokens = TokenManager(
+            config,
+            self.SESSION,
+            cache_dir=config.get("token_cache_dir") or config.get("cache_dir"),
+        )
         self.config = config
         self.event_state = event_state
         self.timeout = timeout
+        self.shard = Shard.parse(config["shard"]) if config.get("shard") else None
+        self.shard_bounds: Dict[str, Tuple[int, Optional[int]]] = {}
+        # the max id each object type is split by, set by the streams from the state
+        # and kept there, so every run of every shard splits the same way
+        self.shard_max_ids: Dict[str, int] = {}
+        # set per stream, true when the stream has no bookmark yet
+        self.first_sync = False
+        # records are buffered until this many ids can be sent in one association request
+        self.associations_batch_size = min(
+            config.get("associations_batch_size", ASSOCIATIONS_BATCH_SIZE),
+            ASSOCIATIONS_BATCH_SIZE,
+        )
+        # streams that pass records through unmodified write the raw response JSON
+        self.raw_passthrough = config.get("raw_record_passthrough", False)
+        # listings read by more than one stream are only requested once per run
+        self.memo = ResponseMemo(config.get("memo_max_in_memory", 10_000))
+        # etags of single page listings, sent as If-None-Match and collected per stream
+        self.etags: Dict[str, str] = {}
+        self.response_etags: Dict[str, str] = {}
+        # set by sync when associations are cached between runs
+        self.association_index: Optional[AssociationIndex] = None
+        self.property_history_store: Optional[PropertyHistoryStore] = None
+        self.changed_ids = None
+        if config.get("changed_ids_path"):
+            self.changed_ids = ChangedIds(config["changed_ids_path"])
+        # monotonic time after which streams stop before their next page, set by sync
+        self.deadline: Optional[float] = None
+        # set per stream: the id a resumed search continues after, and whether the
+        # stream's records come from a search sorted by id
+        self.resume_after: Optional[str] = None
+        self.searched = False
+        # set per stream when its records are the objects of the change files, which
+        # do not move the search bookmark
+        self.read_changed_ids = False
+        # requests sent, including retries
+        self.request_count = 0
+        self.quota = DailyQuota(config)
+        self.retry = RetryPolicy(
+            giveup=giveup_http_codes,
+            breaker=CircuitBreaker(
+                error_rate=config.get("circuit_error_rate", 0.5),
+                cooldown=config.get("circuit_cooldown_seconds", 60),
+            ),
+            max_tries=config.get("retry_max_tries", 10),
+            max_time=config.get("retry_max_seconds", 5 * 60),
+        )
+        self.hedger = None
+        if config.get("hedge_requests"):
+            self.hedger = Hedger(
+                count_call=self.count_hedge,
+                percentile=config.get("hedge_percentile", 95),
+                max_fraction=config.get("hedge_max_fraction", 0.05),
+            )
+        # read once per run, usually all at once by the pre-warm phase of sync
+        self.object_properties: Dict[str, List[Dict]] = {}
+        self.enterprise: Optional[bool] = None
 
     def streams(
         self,
@@ -96,7 +251,11 @@ class Hubspot:
         end_date: datetime,
         tap_stream_id: str,
         is_custom_object: bool,
+        first_sync: bool = False,
     ):
+        self.first_sync = first_sync
+        self.searched = False
+        self.read_changed_ids = False
         if is_custom_object:
             yield from self.get_custom_object(start_date, end_date, tap_stream_id)
         elif tap_stream_id == "owners":
@@ -168,16 +327,26 @@ class Hubspot:
 
         properties = self.get_object_properties(obj_type)
 
-        gen = self.search(
-            obj_type, filter_key, start_date, end_date, properties, primary_key
+        gen = self.fetch_objects(
+            obj_type,
+            filter_key,
+            start_date,
+            end_date,
+            properties,
+            primary_key,
+            exportable=True,
         )
 
-        for chunk in chunker(gen, 50):
+        for chunk in chunker(gen, self.associations_batch_size):
             ids: List[str] = [deal["id"] for deal in chunk]
 
-            contacts_associations = self.get_associations(obj_type, "contacts", ids)
-            companies_associations = self.get_associations(obj_type, "companies", ids)
-            property_history = self.get_property_history("deals", ["dealstage"], ids)
+            contacts_associations = self.lookup_associations(obj_type, "contacts", chunk)
+            companies_associations = self.lookup_associations(
+                obj_type, "companies", chunk
+            )
+            property_history = self.lookup_property_history(
+                "deals", self.config.get("deal_property_history", ["dealstage"]), chunk
+            )
 
             for i, deal_id in enumerate(ids):
                 deal = chunk[i]
@@ -197,32 +366,128 @@ class Hubspot:
                     parser.isoparse(self.get_value(deal, ["properties", filter_key])),
                 )
 
+    def get_property_definitions(self, obj_type: str) -> List[Dict]:
+        if obj_type not in self.object_properties:
+            resp = self.do("GET", f"/crm/v3/properties/{obj_type}")
+            self.object_properties[obj_type] = resp.json()["results"]
+        return self.object_properties[obj_type]
+
     def get_object_properties(self, obj_type: str) -> List[str]:
-        resp = self.do("GET", f"/crm/v3/properties/{obj_type}")
-        data = resp.json()
-        return [o["name"] for o in data["results"]]
+        return [o["name"] for o in self.get_property_definitions(obj_type)]
+
+    def get_property_types(self, obj_type: str) -> Dict[str, str]:
+        return {o["name"]: o.get("type") for o in self.get_property_definitions(obj_type)}
 
     def get_property_history(
         self, obj_type: str, properties: List[str], ids: List[str]
     ) -> Dict[str, Dict[str, List[Dict]]]:
+        path = f"/crm/v3/objects/{obj_type}/batch/read"
+        result: Dict[str, Dict[str, List[Dict]]] = {}
+        for chunk in chunker(ids, PROPERTY_HISTORY_BATCH_SIZE):
+            if not chunk:
+                continue
+            body = {
+                "properties": properties,
+                "propertiesWithHistory": properties,
+                "inputs": [{"id": id} for id in chunk],
+            }
+            resp = self.do("POST", path, json=body)
+
+            data = resp.json()
+
+            history = data.get("results", [])
+
+            for entry in history:
+                obj_id = entry["id"]
+                result[obj_id] = entry["propertiesWithHistory"]
+
+        return result
+
+    def lookup_property_history(
+        self, obj_type: str, properties: List[str], records: List[Dict]
+    ) -> Dict[str, Dict[str, List[Dict]]]:
+        if not self.property_history_store:
+            ids = [record["id"] for record in records]
+            return self.get_property_history(obj_type, properties, ids)
+        return self.property_history_store.lookup(
+            obj_type,
+            properties,
+            records,
+            fetch=lambda ids: self.get_property_history(obj_type, properties, ids),
+        )
+
+    def read_objects(
+        self, obj_type: str, ids: List[str], properties: List[str]
+    ) -> Iterable[Dict]:
+        for chunk in chunker(ids, BATCH_READ_SIZE):
+            if not chunk:
+                continue
+            self.check_budget()
+            records = self.read_object_batch(obj_type, chunk, properties)
+            for id in chunk:
+                if id in records:
+                    yield records[id]
+
+    def read_object_batch(
+        self, obj_type: str, ids: List[str], properties: List[str]
+    ) -> Dict[str, Dict]:
+        path = f"/crm/v3/objects/{obj_type}/batch/read"
         body = {
             "properties": properties,
-            "propertiesWithHistory": properties,
             "inputs": [{"id": id} for id in ids],
         }
-        path = f"/crm/v3/objects/{obj_type}/batch/read"
         resp = self.do("POST", path, json=body)
 
-        data = resp.json()
-
-        history = data.get("results", [])
-
-        result: Dict[str, Dict[str, List[Dict]]] = {}
-        for entry in history:
-            obj_id = entry["id"]
-            result[obj_id] = entry["propertiesWithHistory"]
+        # results come back in no particular order, ids that no longer exist
+        # are left out
+        return {record["id"]: record for record in resp.json().get("results", [])}
 
-        return result
+    def search_column_groups(
+        self,
+        object_type: str,
+        filter_key: str,
+        start_date: datetime,
+        end_date: datetime,
+        properties: List[str],
+        primary_key: str,
+        group_size: int,
+    ) -> Iterable[Dict]:
+        # a search for thousands of properties is slow on both ends, so the search
+        # only finds the ids and the properties are read in groups concurrently
+        groups = [
+            properties[i : i + group_size] for i in range(0, len(properties), group_size)
+        ]
+        LOGGER.info(
+            f"reading {len(properties)} {object_type} properties in {len(groups)} groups"
+        )
+        lean = self.search(
+            object_type, filter_key, start_date, end_date, [filter_key], primary_key
+        )
+        workers = self.config.get("property_group_workers", 4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk in chunker(lean, BATCH_READ_SIZE):
+                if not chunk:
+                    continue
+                self.check_budget()
+                ids = [record["id"] for record in chunk]
+                parts = list(
+                    executor.map(
+                        lambda group: self.read_object_batch(object_type, ids, group),
+                        groups,
+                    )
+                )
+                for record in chunk:
+                    found = [part[record["id"]] for part in parts if record["id"] in part]
+                    # deleted since the search, the archived streams pick it up
+                    if not found:
+                        continue
+                    merged: Dict[str, Any] = {}
+                    for part in found:
+                        merged.update(part.get("properties", {}))
+                    # the search result decides the bookmark, so its values win over
+                    # the ones read a moment later
+                    merged.update(record.get("properties", {}))
+                    yield {**record, "properties": merged}
 
     def get_associations(
         self,
@@ -230,18 +495,167 @@ class Hubspot:
         to_obj: str,
         ids: List[str],
     ) -> Dict[str, List[Any]]:
-        body = {"inputs": [{"id": id} for id in ids]}
         path = f"/crm/v4/associations/{from_obj}/{to_obj}/batch/read"
 
-        resp = self.do("POST", path, json=body)
-
         result: Dict[str, List[Any]] = {}
-        for ass in resp.json().get("results", []):
-            ass_id = ass["from"]["id"]
-            result[ass_id] = ass["to"]
+        for chunk in chunker(ids, ASSOCIATIONS_BATCH_SIZE):
+            if not chunk:
+                continue
+            body = {"inputs": [{"id": id} for id in chunk]}
+            resp = self.do("POST", path, json=body)
+
+            for ass in resp.json().get("results", []):
+                ass_id = ass["from"]["id"]
+                result.setdefault(ass_id, []).extend(ass["to"])
+
+                # objects with many associations only get the first page of them
+                after = self.get_value(ass, ["paging", "next", "after"])
+                if after:
+                    result[ass_id].extend(
+                        self.get_remaining_associations(from_obj, to_obj, ass_id, after)
+                    )
 
         return result
 
+    def lookup_associations(
+        self, from_obj: str, to_obj: str, records: List[Dict]
+    ) -> Dict[str, List[Any]]:
+        if not self.association_index:
+            ids = [record["id"] for record in records]
+            return self.get_associations(from_obj, to_obj, ids)
+        return self.association_index.lookup(
+            from_obj,
+            to_obj,
+            records,
+            fetch=lambda ids: self.get_associations(from_obj, to_obj, ids),
+        )
+
+    def get_remaining_associations(
+        self, from_obj: str, to_obj: str, id: str, after: str
+    ) -> Iterable[Any]:
+        path = f"/crm/v4/objects/{from_obj}/{id}/associations/{to_obj}"
+        params = {"limit": 500, "after": after}
+        yield from self.paginate(
+            path, params=params, data_field="results", offset_key="after"
+        )
+
+    def fetch_objects(
+        self,
+        object_type: str,
+        filter_key: str,
+        start_date: datetime,
+        end_date: datetime,
+        properties: List[str],
+        primary_key: str,
+        exportable: bool = False,
+    ) -> Iterable[Dict]:
+        if exportable and self.first_sync and self.config.get("export_backfill"):
+            LOGGER.info(f"no bookmark for {object_type}, backfilling from a CRM export")
+            return self.export(
+                object_type, filter_key, start_date, end_date, properties, primary_key
+            )
+        changed_object_types = self.config.get(
+            "changed_ids_object_types", ["contacts", "companies", "deals"]
+        )
+        if (
+            self.changed_ids
+            and not self.first_sync
+            and object_type in changed_object_types
+        ):
+            LOGGER.info(f"reading changed {object_type} instead of searching")
+            self.read_changed_ids = True
+            return self.read_objects(
+                object_type, self.changed_ids.ids(object_type), properties
+            )
+        group_size = self.config.get("property_group_size")
+        if group_size and len(properties) > group_size:
+            return self.search_column_groups(
+                object_type,
+                filter_key,
+                start_date,
+                end_date,
+                properties,
+                primary_key,
+                group_size,
+            )
+        return self.search(
+            object_type, filter_key, start_date, end_date, properties, primary_key
+        )
+
+    def export(
+        self,
+        object_type: str,
+        filter_key: str,
+        start_date: datetime,
+        end_date: datetime,
+        properties: List[str],
+        primary_key: str,
+    ) -> Iterable[Dict]:
+        filters = [
+            {
+                "propertyName": filter_key,
+                "operator": "GTE",
+                "value": str(int(start_date.timestamp() * 1000)),
+            },
+            {
+                "propertyName": filter_key,
+                "operator": "LT",
+                "value": str(int(end_date.timestamp() * 1000)),
+            },
+        ]
+        if self.shard:
+            lower, upper = self.get_shard_bounds(object_type, primary_key)
+            filters.append(
+                {"propertyName": primary_key, "operator": "GTE", "value": str(lower)}
+            )
+            if upper is not None:
+                filters.append(
+                    {"propertyName": primary_key, "operator": "LT", "value": str(upper)}
+                )
+
+        body = {
+            "exportType": "VIEW",
+            "format": "CSV",
+            "exportName": f"tap-hubspot {object_type} backfill",
+            "objectType": export_object_type(object_type),
+            "objectProperties": properties,
+            "language": "EN",
+            "exportInternalValuesOptions": ["NAMES", "VALUES"],
+            "publicCrmSearchRequest": {"filters": filters},
+        }
+        resp = self.do("POST", "/crm/v3/exports/export/async", json=body)
+        export_id = resp.json()["id"]
+        LOGGER.info(f"started export {export_id} of {object_type}")
+
+        url = self.wait_for_export(export_id)
+
+        # the export file is spooled to disk, a zipped export can only be read
+        # with random access
+        with tempfile.TemporaryFile() as f:
+            with self.SESSION.get(url, stream=True, timeout=self.timeout) as resp:
+                resp.raise_for_status()
+                for block in resp.iter_content(chunk_size=1024 * 1024):
+                    f.write(block)
+            yield from parse_export(f, self.get_property_types(object_type))
+
+    def wait_for_export(self, export_id: str) -> str:
+        poll_interval = self.config.get("export_poll_interval", 10)
+        deadline = time.monotonic() + self.config.get("export_timeout", 6 * 60 * 60)
+        path = f"/crm/v3/exports/export/async/tasks/{export_id}/status"
+        while True:
+            self.check_budget()
+            resp = self.do("GET", path)
+            data = resp.json()
+            status = data.get("status")
+            if status == "COMPLETE":
+                return data["result"]
+            if status in ("CANCELED", "FAILED"):
+                raise Exception(f"export {export_id} ended with status {status}: {data}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"export {export_id} did not complete in time")
+            LOGGER.info(f"export {export_id} is {status}, waiting")
+            time.sleep(poll_interval)
+
     def search(
         self,
         object_type: str,
@@ -255,27 +669,64 @@ class Hubspot:
         path = f"/crm/v3/objects/{object_type}/search"
         after: int = 0
         primary_key_value = "0"
+        primary_key_max = None
+        if self.shard:
+            lower, upper = self.get_shard_bounds(object_type, primary_key)
+            primary_key_value = str(lower)
+            primary_key_max = str(upper) if upper is not None else None
+        if self.resume_after is not None:
+            primary_key_value = str(max(int(primary_key_value), int(self.resume_after) + 1))
+            self.resume_after = None
+        self.searched = True
+
+        page_size = AdaptivePageSize(
+            path,
+            maximum=self.config.get("search_page_size", limit),
+            minimum=self.config.get("search_min_page_size", 10),
+        )
+        max_retries = self.config.get("search_max_retries", 10)
+        max_520_retries = self.config.get("search_max_520_retries", 5)
+        retries = 0
+        retries_520 = 0
         while True:
+            self.check_budget()
+            body = self.build_search_body(
+                start_date,
+                end_date,
+                properties,
+                filter_key,
+                after,
+                primary_key,
+                primary_key_value,
+                limit=page_size.size,
+                primary_key_max=primary_key_max,
+            )
+            started = time.monotonic()
             try:
-                body = self.build_search_body(
-                    start_date,
-                    end_date,
-                    properties,
-                    filter_key,
-                    after,
-                    primary_key,
-                    primary_key_value,
-                    limit=limit,
-                )
                 resp = self.do(
                     "POST",
                     path,
                     json=body,
+                    fail_fast=True,
                 )
-            except requests.HTTPError as err:
-                if err.response.status_code == 520:
-                    continue
-                raise
+            except TransientError as err:
+                # wide pages time out or fail on the server side, retrying them at
+                # the same size rarely helps. retries counts the failures of this
+                # page, retries_520 those of the whole search
+                retries += 1
+                if err.status_code == 520:
+                    retries_520 += 1
+                if retries > max_retries or retries_520 > max_520_retries:
+                    raise err.cause
+                page_size.shrink()
+                delay = random.uniform(0, min(60, 2**retries))
+                LOGGER.warning(
+                    f"search {object_type} failed with {err.status_code or 'a timeout'}, retrying with {page_size.size} records per page in {delay:.1f}s"
+                )
+                time.sleep(delay)
+                continue
+            retries = 0
+            page_size.observe(time.monotonic() - started, len(resp.content))
 
             try:
                 data = resp.json()
@@ -323,6 +774,7 @@ class Hubspot:
         primary_key: str,
         primary_key_value: str,
         limit: int = 100,
+        primary_key_max: Optional[str] = None,
     ):
         q = {
             "filterGroups": [
@@ -353,17 +805,56 @@ class Hubspot:
             "limit": limit,
             "after": after,
         }
+        if primary_key_max is not None:
+            q["filterGroups"][0]["filters"].append(
+                {
+                    "propertyName": primary_key,
+                    "operator": "LT",
+                    "value": primary_key_max,
+                }
+            )
         return q
 
+    def get_shard_bounds(
+        self, object_type: str, primary_key: str
+    ) -> Tuple[int, Optional[int]]:
+        if object_type not in self.shard_bounds:
+            max_id = self.config.get("shard_max_ids", {}).get(
+                object_type, self.shard_max_ids.get(object_type)
+            )
+            if max_id is None:
+                max_id = round_max_id(self.get_max_object_id(object_type, primary_key))
+            self.shard_max_ids[object_type] = int(max_id)
+            bounds = self.shard.bounds(int(max_id))
+            LOGGER.info(
+                f"shard {self.shard} of {object_type} covers {primary_key} in [{bounds[0]}, {bounds[1]})"
+            )
+            self.shard_bounds[object_type] = bounds
+        return self.shard_bounds[object_type]
+
+    def get_max_object_id(self, object_type: str, primary_key: str) -> int:
+        body = {
+            "properties": [primary_key],
+            "sorts": [{"propertyName": primary_key, "direction": "DESCENDING"}],
+            "limit": 1,
+        }
+        resp = self.do("POST", f"/crm/v3/objects/{object_type}/search", json=body)
+        records = resp.json().get("results", [])
+        if not records:
+            return 0
+        return int(records[0]["id"])
+
     def attach_engagement_associations(
         self, obj_type: str, search_result: Iterable[Dict], replication_path: List[str]
     ) -> Iterable[Tuple[Dict, datetime]]:
-        for chunk in chunker(search_result, 100):
+        for chunk in chunker(search_result, self.associations_batch_size):
             ids: List[str] = [engagement["id"] for engagement in chunk]
 
-            companies_associations = self.get_associations(obj_type, "companies", ids)
-            contacts_associations = self.get_associations(obj_type, "contacts", ids)
-            deals_associations = self.get_associations(obj_type, "deals", ids)
+            companies_associations = self.lookup_associations(
+                obj_type, "companies", chunk
+            )
+            contacts_associations = self.lookup_associations(obj_type, "contacts", chunk)
+            deals_associations = self.lookup_associations(obj_type, "deals", chunk)
 
             for i, engagement_id in enumerate(ids):
                 engagement = chunk[i]
@@ -383,16 +874,13 @@ class Hubspot:
                 )
 
     def get_properties(self, object_type: str):
-        path = f"/crm/v3/properties/{object_type}"
-        data_field = "results"
+        # the definitions are usually read by the pre-warm already
         replication_path = ["updatedAt"]
-        offset_key = "after"
-        yield from self.get_records(
-            path,
-            replication_path,
-            data_field=data_field,
-            offset_key=offset_key,
-        )
+        for record in self.get_property_definitions(object_type):
+            replication_value = self.get_value(record, replication_path)
+            if replication_value:
+                replication_value = parser.isoparse(replication_value)
+            yield record, replication_value
 
     def get_owners(self):
         path = "/crm/v3/owners"
@@ -406,6 +894,7 @@ class Hubspot:
             params=params,
             data_field=data_field,
             offset_key=offset_key,
+            raw=self.raw_passthrough,
         )
 
     def get_communications(
@@ -415,7 +904,7 @@ class Hubspot:
         obj_type = "communications"
         properties = self.get_object_properties(obj_type)
         primary_key = "hs_object_id"
-        gen = self.search(
+        gen = self.fetch_objects(
             obj_type, filter_key, start_date, end_date, properties, primary_key
         )
 
@@ -462,8 +951,14 @@ class Hubspot:
 
         properties = self.get_object_properties(obj_type)
 
-        companies = self.search(
-            obj_type, filter_key, start_date, end_date, properties, primary_key
+        companies = self.fetch_objects(
+            obj_type,
+            filter_key,
+            start_date,
+            end_date,
+            properties,
+            primary_key,
+            exportable=True,
         )
 
         for company in companies:
@@ -480,11 +975,21 @@ class Hubspot:
         primary_key = "hs_object_id"
         properties = self.get_object_properties(obj_type)
 
-        gen = self.search(
-            obj_type, filter_key, start_date, end_date, properties, primary_key
+        gen = self.fetch_objects(
+            obj_type,
+            filter_key,
+            start_date,
+            end_date,
+            properties,
+            primary_key,
+            exportable=True,
         )
 
-        for chunk in chunker(gen, 100):
+        refetched: Set[str] = set()
+        if self.config.get("contacts_tracking_refetch"):
+            gen = self.with_pending_tracking_contacts(gen, properties, refetched)
+
+        for chunk in chunker(gen, self.associations_batch_size):
             ids: List[str] = [contact["id"] for contact in chunk]
             companies_associations = self.get_associations("contacts", "companies", ids)
 
@@ -496,13 +1001,63 @@ class Hubspot:
                 }
 
                 self.store_ids_submissions(contact)
+                if contact["id"] in refetched:
+                    # refetched contacts are older than the bookmark, they must not move
+                    # it. Their events are outside this run's window, so they are
+                    # read regardless of it
+                    self.event_state["contacts_events_ids"][contact["id"]] = None
+                    self.event_state["contacts_events_ids"].sync()
+                    yield contact, None
+                    continue
                 replication_value = parser.isoparse(
                     self.get_value(contact, ["properties", filter_key])
                 )
 
                 yield contact, replication_value
 
+    def with_pending_tracking_contacts(
+        self, contacts: Iterable[Dict], properties: List[str], refetched: Set[str]
+    ) -> Iterable[Dict]:
+        # hubspot fills in the tracking properties of new contacts with a delay. The
+        # contacts that were emitted without them in the previous run are read
+        # again after the search, unless the search returned them anyway.
+        pending = set(self.event_state["contacts_pending_tracking_ids"])
+        for contact in contacts:
+            pending.discard(contact["id"])
+            self.store_pending_tracking_id(contact)
+            yield contact
+
+        if not pending:
+            return
+        LOGGER.info(f"refetching {len(pending)} contacts without tracking data")
+        refetched.update(pending)
+        for contact in self.read_objects("contacts", sorted(pending, key=int), properties):
+            self.store_pending_tracking_id(contact)
+            yield contact
+
+    def store_pending_tracking_id(self, contact: Dict):
+        next_pending = self.event_state["contacts_pending_tracking_ids_next"]
+        contact_id = contact["id"]
+        next_pending.discard(contact_id)
+
+        if all(
+            self.get_value(contact, ["properties", name])
+            for name in TRACKING_PROPERTIES
+        ):
+            return
+        created = self.get_value(contact, ["properties", "createdate"])
+        if not created:
+            return
+        max_age = timedelta(
+            hours=self.config.get("contacts_tracking_refetch_max_age_hours", 48)
+        )
+        if parser.isoparse(created) > datetime.now(timezone.utc) - max_age:
+            next_pending.add(contact_id)
+
     def get_contact_lists(self) -> Iterable:
+        yield from self.memo.replay_or_record("contact_lists", self._get_contact_lists)
+
+    def _get_contact_lists(self) -> Iterable:
         offset = 0
         replication_path = ["updatedAt"]
         has_more = True
@@ -524,7 +1079,7 @@ class Hubspot:
             offset = data["offset"]
             body["offset"] = offset
 
-    def should_sync_all_contact_list(self, event_settings: EventSettings) -> bool:
+    def should_sync_all_contact_list(self, event_settings: "EventSettings") -> bool:
         unique_operators = event_settings.get_unique_operators("contact_lists")
         if not unique_operators:
             return False
@@ -555,6 +1110,8 @@ class Hubspot:
                 "No event settings found, skipping syncing contacts in contact lists to save time"
             )
             return
+        from tap_hubspot.event_settings import EventSettings
+
         event_settings_dict = json.loads(event_settings)
         parsed_event_settings = EventSettings(
             **dict(event_settings=event_settings_dict)
@@ -607,7 +1164,7 @@ class Hubspot:
         properties = self.get_object_properties(obj_type)
         primary_key = "hs_object_id"
 
-        gen = self.search(
+        gen = self.fetch_objects(
             obj_type, filter_key, start_date, end_date, properties, primary_key
         )
         return self.attach_engagement_associations(
@@ -623,7 +1180,7 @@ class Hubspot:
         obj_type = "meetings"
         properties = self.get_object_properties(obj_type)
         primary_key = "hs_object_id"
-        gen = self.search(
+        gen = self.fetch_objects(
             obj_type, filter_key, start_date, end_date, properties, primary_key
         )
 
@@ -641,7 +1198,7 @@ class Hubspot:
         properties = self.get_object_properties(obj_type)
         primary_key = "hs_object_id"
 
-        gen = self.search(
+        gen = self.fetch_objects(
             obj_type, filter_key, start_date, end_date, properties, primary_key
         )
 
@@ -659,7 +1216,7 @@ class Hubspot:
         properties = self.get_object_properties(obj_type)
         primary_key = "hs_object_id"
 
-        gen = self.search(
+        gen = self.fetch_objects(
             obj_type, filter_key, start_date, end_date, properties, primary_key
         )
 
@@ -676,7 +1233,7 @@ class Hubspot:
         obj_type = "tasks"
         properties = self.get_object_properties(obj_type)
         primary_key = "hs_object_id"
-        gen = self.search(
+        gen = self.fetch_objects(
             obj_type, filter_key, start_date, end_date, properties, primary_key
         )
 
@@ -692,31 +1249,113 @@ class Hubspot:
         offset_key = "after"
         replication_path = ["updatedAt"]
         yield from self.get_records(
-            path, replication_path, data_field=data_field, offset_key=offset_key
+            path,
+            replication_path,
+            data_field=data_field,
+            offset_key=offset_key,
+            raw=self.raw_passthrough,
         )
 
     def get_email_events(self, start_date: datetime, end_date: datetime):
         start_date: int = self.datetime_to_milliseconds(start_date)
         end_date: int = self.datetime_to_milliseconds(end_date)
+        event_types = self.config.get("email_event_types", ["CLICK"])
+        if self.config.get("email_events_slice_hours"):
+            yield from self.get_email_event_slices(start_date, end_date, event_types)
+            return
+
         path = "/email/public/v1/events"
         data_field = "events"
         replication_path = ["created"]
-        params = {
-            "startTimestamp": start_date,
-            "endTimestamp": end_date,
-            "limit": 1000,
-            "eventType": "CLICK",
-        }
         offset_key = "offset"
+        for event_type in event_types:
+            params = {
+                "startTimestamp": start_date,
+                "endTimestamp": end_date,
+                "limit": 1000,
+                "eventType": event_type,
+            }
+            yield from self.get_records(
+                path,
+                replication_path,
+                params=params,
+                data_field=data_field,
+                offset_key=offset_key,
+                raw=self.raw_passthrough,
+            )
 
-        yield from self.get_records(
-            path,
-            replication_path,
-            params=params,
-            data_field=data_field,
-            offset_key=offset_key,
+    def get_email_event_slices(
+        self, start: int, end: int, event_types: List[str]
+    ) -> Iterable[Tuple[Dict, None]]:
+        # Reads the events in time slices, every event type of a few slices at once.
+        # A slice is completed once all its events are emitted. The stream's bookmark
+        # only moves past completed slices, and the ones completed after a gap are
+        # kept in the state, so a failed run only reads what it did not complete.
+        hours = self.config["email_events_slice_hours"]
+        completed = self.event_state.get("email_events_completed_slices") or []
+        self.event_state["email_events_completed_slices"] = completed
+        self.event_state["email_events_start"] = start
+        pending = iter(
+            [
+                time_slice
+                for time_slice in time_slices(start, end, int(hours * 3600 * 1000))
+                if not is_covered(time_slice, completed)
+            ]
         )
 
+        def read(time_slice: Slice, event_type: str) -> List[Dict]:
+            params = {
+                "startTimestamp": time_slice[0],
+                # both ends are inclusive
+                "endTimestamp": time_slice[1] - 1,
+                "limit": 1000,
+                "eventType": event_type,
+            }
+            return list(
+                self.paginate(
+                    "/email/public/v1/events",
+                    params=params,
+                    data_field="events",
+                    offset_key="offset",
+                    raw=self.raw_passthrough,
+                )
+            )
+
+        workers = self.config.get("email_events_workers", 4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # slices are emitted in order, at most workers of them are read ahead
+            window: Deque[Tuple[Slice, List[Future]]] = deque()
+
+            def read_next_slice():
+                time_slice = next(pending, None)
+                if time_slice:
+                    futures = [
+                        executor.submit(read, time_slice, event_type)
+                        for event_type in event_types
+                    ]
+                    window.append((time_slice, futures))
+
+            for _ in range(workers):
+                read_next_slice()
+            error: Optional[Exception] = None
+            while window:
+                time_slice, futures = window.popleft()
+                read_next_slice()
+                try:
+                    for future in futures:
+                        for record in future.result():
+                            yield record, None
+                except (BudgetExhausted, CircuitOpen):
+                    raise
+                except Exception as err:
+                    # the other slices are still read, the stream fails at the end
+                    LOGGER.warning(f"failed to read email events of slice {time_slice}: {err!r}")
+                    error = error or err
+                    continue
+                completed.append(list(time_slice))
+            if error:
+                raise error
+
     def get_marketing_campaign_list(self) -> Iterable:
         path = "/marketing/v3/campaigns"
         data_field = "results"
@@ -790,7 +1429,10 @@ class Hubspot:
     def get_forms(self):
         path = "/forms/v2/forms"
         replication_path = ["updatedAt"]
-        yield from self.get_records(path, replication_path)
+        yield from self.memo.replay_or_record(
+            "forms",
+            lambda: self.get_records(path, replication_path, raw=self.raw_passthrough),
+        )
 
     def get_guids_from_endpoint(self) -> set:
         forms = set()
@@ -844,8 +1486,14 @@ class Hubspot:
         filter_key = "hs_lastmodifieddate"
         primary_key = "hs_object_id"
         properties = self.get_object_properties(obj_type)
-        gen = self.search(
-            obj_type, filter_key, start_date, end_date, properties, primary_key
+        gen = self.fetch_objects(
+            obj_type,
+            filter_key,
+            start_date,
+            end_date,
+            properties,
+            primary_key,
+            exportable=True,
         )
 
         return self.attach_engagement_associations(
@@ -855,7 +1503,10 @@ class Hubspot:
         )
 
     def is_enterprise(self):
+        if self.enterprise is not None:
+            return self.enterprise
         path = "/events/v3/events"
+        enterprise = True
         try:
             self.test_endpoint(url=path)
         except requests.exceptions.HTTPError as err:
@@ -863,8 +1514,9 @@ class Hubspot:
                 LOGGER.info(
                     "The company's account does not belong to Marketing Hub Enterprise. No event data can be retrieved"
                 )
-                return False
-        return True
+                enterprise = False
+        self.enterprise = enterprise
+        return enterprise
 
     def get_contacts_events(self):
         # contacts_events data is retrieved according to contact id
@@ -873,7 +1525,19 @@ class Hubspot:
         path = "/events/v3/events"
         if not self.is_enterprise():
             return None, None
-        for contact_id in self.event_state["contacts_events_ids"]:
+        # the contacts a previous run did not get to come first, the stream saves
+        # the ones after contacts_events_done when it is stopped
+        queue = list(
+            dict.fromkeys(
+                [
+                    *self.event_state["contacts_events_pending_ids"],
+                    *self.event_state["contacts_events_ids"],
+                ]
+            )
+        )
+        self.event_state["contacts_events_queue"] = queue
+        for done, contact_id in enumerate(queue):
+            self.event_state["contacts_events_done"] = done
             params = {
                 "limit": 100000,
                 "objectType": "contact",
@@ -897,19 +1561,29 @@ class Hubspot:
         data_field = "results"
         offset_key = "after"
         params = {"limit": 100}
-        yield from self.get_records(
-            path,
-            params=params,
-            data_field=data_field,
-            offset_key=offset_key,
+        yield from self.memo.replay_or_record(
+            "marketing_events",
+            lambda: self.get_records(
+                path,
+                params=params,
+                data_field=data_field,
+                offset_key=offset_key,
+            ),
         )
 
     def get_marketing_event_participations(self):
         data_field = "results"
         offset_key = "after"
         params = {"limit": 100}
+        skipped = 0
+        # events read by a previous run that was stopped, the stream saves the list
+        done = self.event_state.get("marketing_event_participations_done") or []
+        self.event_state["marketing_event_participations_done"] = done
+        done_before = set(done)
         for event, _ in self.get_marketing_events():
             event_id = event["objectId"]
+            if event_id in done_before:
+                continue
             path = f"/marketing/v3/marketing-events/participations/{event_id}/breakdown"
             try:
                 for record, replication_value in self.get_records(
@@ -919,6 +1593,11 @@ class Hubspot:
                     offset_key=offset_key,
                 ):
                     yield record, replication_value
+                done.append(event_id)
+            except CircuitOpen:
+                # the breakdowns of the other events are likely failing as well
+                skipped += 1
+                continue
             except (requests.exceptions.HTTPError, RetryAfterReauth) as err:
                 if isinstance(err, RetryAfterReauth):
                     LOGGER.warning(
@@ -939,6 +1618,10 @@ class Hubspot:
                     )
                     continue
                 raise
+        if skipped:
+            LOGGER.warning(
+                f"skipped the participations of {skipped} marketing events while their endpoint was failing"
+            )
 
     def get_users_teams(self):
         data_field = "results"
@@ -947,6 +1630,7 @@ class Hubspot:
             yield from self.get_records(
                 path,
                 data_field=data_field,
+                raw=self.raw_passthrough,
             )
         except MissingScope:
             LOGGER.info(
@@ -1027,10 +1711,16 @@ class Hubspot:
             self.event_state["contacts_events_ids"].sync()
 
     def get_records(
-        self, path, replication_path=None, params=None, data_field=None, offset_key=None
+        self,
+        path,
+        replication_path=None,
+        params=None,
+        data_field=None,
+        offset_key=None,
+        raw=False,
     ):
         for record in self.paginate(
-            path, params=params, data_field=data_field, offset_key=offset_key
+            path, params=params, data_field=data_field, offset_key=offset_key, raw=raw
         ):
             try:
                 replication_value = self.milliseconds_to_datetime(
@@ -1042,6 +1732,13 @@ class Hubspot:
                     replication_value = parser.isoparse(replication_value)
             yield record, replication_value
 
+    def check_budget(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise BudgetExhausted
+        reason = self.quota.exhausted()
+        if reason:
+            raise QuotaExhausted(reason)
+
     def get_value(self, obj: dict, path_to_replication_key=None, default=None):
         if not path_to_replication_key:
             return default
@@ -1058,18 +1755,40 @@ class Hubspot:
         return int(d.timestamp() * 1000) if d else None
 
     def paginate(
-        self, path: str, params: Dict = None, data_field: str = None, offset_key=None
+        self,
+        path: str,
+        params: Dict = None,
+        data_field: str = None,
+        offset_key=None,
+        raw=False,
     ):
         params = params or {}
         offset_value = None
+        page = 0
         while True:
+            self.check_budget()
             if offset_value:
                 params[offset_key] = offset_value
 
-            resp = self.do("GET", path, params=params)
+            headers = None
+            if page == 0 and path in self.etags:
+                headers = {"If-None-Match": self.etags[path]}
+            resp = self.do("GET", path, params=params, headers=headers)
+            if resp.status_code == 304:
+                raise NotModified(path)
+
+            # only listings that fit on a single page can be requested conditionally
+            page += 1
+            if page == 1 and resp.headers.get("ETag"):
+                self.response_etags[path] = resp.headers["ETag"]
+            else:
+                self.response_etags.pop(path, None)
             try:
-                data = resp.json()
-            except simplejson.JSONDecodeError:
+                if raw:
+                    data = decode_response(resp.text, data_field)
+                else:
+                    data = resp.json()
+            except (simplejson.JSONDecodeError, ValueError):
                 LOGGER.exception(
                     f"Failed to decode the response to json: '{resp.text}'"
                 )
@@ -1086,32 +1805,22 @@ class Hubspot:
                     return
                 yield from d
 
-            if offset_key:
-                if "paging" in data:
-                    offset_value = self.get_value(data, ["paging", "next", "after"])
-                elif "vid-offset" in data:
-                    offset_value = data.get("vid-offset")
-                    if data.get("has-more") == False:
-                        return
-                else:
-                    offset_value = data.get(offset_key)
+            offset_value = self.next_offset(data, offset_key)
             if not offset_value:
                 break
 
-    @backoff.on_exception(
-        backoff.expo,
-        (
-            requests.exceptions.RequestException,
-            ratelimit.RateLimitException,
-            RetryAfterReauth,
-            requests.exceptions.ReadTimeout,
-        ),
-        giveup=giveup_http_codes,
-        jitter=backoff.full_jitter,
-        max_tries=10,
-        max_time=5 * 60,
-    )
-    @limits(calls=110, period=10)
+    def next_offset(self, data: Dict, offset_key: Optional[str]) -> Optional[Any]:
+        # the offset of the next page of a listing, None after the last page
+        if not offset_key:
+            return None
+        if "paging" in data:
+            return self.get_value(data, ["paging", "next", "after"])
+        if "vid-offset" in data:
+            if data.get("has-more") == False:
+                return None
+            return data.get("vid-offset")
+        return data.get(offset_key)
+
     def do(
         self,
         method: str,
@@ -1119,58 +1828,75 @@ class Hubspot:
         data: Optional[Any] = None,
         json: Optional[Any] = None,
         params: Optional[Any] = None,
+        headers: Optional[Dict[str, str]] = None,
+        fail_fast: bool = False,
+    ) -> requests.Response:
+        return self.retry.call(
+            endpoint_template(url),
+            lambda: self.do_once(method, url, data, json, params, headers, fail_fast),
+        )
+
+    @RATE_LIMIT
+    def do_once(
+        self,
+        method: str,
+        url: str,
+        data: Optional[Any] = None,
+        json: Optional[Any] = None,
+        params: Optional[Any] = None,
+        headers: Optional[Dict[str, str]] = None,
+        fail_fast: bool = False,
     ) -> requests.Response:
         params = params or {}
         url = f"{self.BASE_URL}{url}"
-        headers = {"Authorization": f"Bearer {self.access_token}"}
+        access_token = self.ensure_access_token()
+        headers = {**(headers or {}), "Authorization": f"Bearer {access_token}"}
+        self.request_count += 1
 
-        # access_token is cached
         try:
-            self.refresh_access_token()
-        except requests.HTTPError as err:
-            if err.response.status_code == 400:
+            with self.send(
+                method,
+                url,
+                headers=headers,
+                params=params,
+                timeout=endpoint_timeout(self.config, url, self.timeout),
+                json=json,
+                data=data,
+            ) as response:
+                self.quota.observe(response.headers)
                 try:
-                    err_data: Dict = err.response.json()
-                    msg = err_data.get("message")
-                    if msg is None:
-                        msg = "invalid credentials"
-                    raise InvalidCredentials(msg)
-                except Exception:
-                    raise InvalidCredentials(err.response.text)
+                    raise_for_hubspot_error(
+                        response.status_code, response.text, response
+                    )
+                except RetryAfterReauth:
+                    # the token was revoked or expired early, the retry gets a new one
+                    self.tokens.invalidate(access_token)
+                    raise
+
+                LOGGER.debug(response.url)
+                response.raise_for_status()
+                return response
+        except (requests.Timeout, requests.HTTPError) as err:
+            if fail_fast and is_transient(err):
+                raise TransientError(err) from err
             raise
 
-        with self.SESSION.request(
-            method,
-            url,
-            headers=headers,
-            params=params,
-            timeout=self.timeout,
-            json=json,
-            data=data,
-        ) as response:
-            if response.status_code == 401:
-                raise RetryAfterReauth
-
-            if response.status_code == 403:
-                err_msg: Dict = response.json()
-
-                # if there is no category, the error message is a legacy error message, and might have another
-                # format. https://legacydocs.hubspot.com/docs/faq/api-error-responses
-                if err_msg.get("category") is None:
-                    if (
-                        "You do not have permissions to view object type"
-                        in err_msg.get("message")
-                    ):
-                        raise MissingScope(err_msg)
-                if err_msg.get("category") == "MISSING_SCOPES":
-                    raise MissingScope(err_msg)
-
-            if response.status_code == 400:
-                raise BadRequest(f"Bad Request: {response.text}", response=response)
-
-            LOGGER.debug(response.url)
-            response.raise_for_status()
-            return response
+    def count_hedge(self):
+        # a hedge is a request of its own for the rate limit and the daily quota
+        count_rate_limited_call()
+        self.request_count += 1
+        self.quota.count_request()
+
+    def send(self, method: str, url: str, **kwargs) -> requests.Response:
+        if not self.hedger or not is_idempotent(method, url):
+            return self.SESSION.request(method, url, **kwargs)
+        template = endpoint_template(url)
+        started = time.monotonic()
+        response = self.hedger.request(
+            template, lambda: self.SESSION.request(method, url, **kwargs)
+        )
+        self.hedger.latencies.observe(template, time.monotonic() - started)
+        return response
 
     def get_portal_id(self) -> int:
         try:
@@ -1183,41 +1909,31 @@ class Hubspot:
             LOGGER.warning("Failed to get portal ID")
             return
 
+    def ensure_access_token(self) -> str:
+        try:
+            self.access_token = self.tokens.get()
+            return self.access_token
+        except requests.HTTPError as err:
+            if err.response.status_code == 400:
+                try:
+                    err_data: Dict = err.response.json()
+                    msg = err_data.get("message")
+                    if msg is None:
+                        msg = "invalid credentials"
+                    raise InvalidCredentials(msg)
+                except Exception:
+                    raise InvalidCredentials(err.response.text)
+            raise
+
     def test_endpoint(self, url, params={}):
-        self.refresh_access_token()
+        access_token = self.ensure_access_token()
 
         url = f"{self.BASE_URL}{url}"
-        headers = {"Authorization": f"Bearer {self.access_token}"}
+        headers = {"Authorization": f"Bearer {access_token}"}
         with self.SESSION.get(
-            url, headers=headers, params=params, timeout=self.timeout
+            url,
+            headers=headers,
+            params=params,
+            timeout=endpoint_timeout(self.config, url, self.timeout),
         ) as response:
             response.raise_for_status()
-
-    def refresh_access_token(self):
-        if self.access_token_ttl and datetime.utcnow() < self.access_token_ttl:
-            return
-
-        payload = {
-            "grant_type": "refresh_token",
-            "refresh_token": self.config["refresh_token"],
-            "client_id": self.config["client_id"],
-            "client_secret": self.config["client_secret"],
-        }
-
-        resp = requests.post(self.BASE_URL + "/oauth/v1/token", data=payload)
-        if resp.status_code == 403:
-            raise InvalidCredentials(resp.text)
-        resp.raise_for_status()
-
-        if not resp:
-            raise Exception(resp.text)
-
-        data = resp.json()
-
-        # cache the access_token for ttl (default is 1800 seconds)
-        # subtract 5 minutes just to be super sure.
-        expires_in_seconds = data["expires_in"]
-        self.access_token_ttl = datetime.utcnow() + timedelta(
-            seconds=expires_in_seconds - 60 * 5
-        )
-        self.access_token = data["access_token"]
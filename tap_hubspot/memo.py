@@ -0,0 +1,59 @@
+import pickle
+import tempfile
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import singer
+
+LOGGER = singer.get_logger()
+
+
+class Listing:
+    # the items of one complete listing, the first max_in_memory are kept in memory
+    # and the rest is spilled to a temporary file
+    def __init__(self, max_in_memory: int):
+        self.max_in_memory = max_in_memory
+        self.items: List[Any] = []
+        self.spill: Optional[Any] = None
+        self.size = 0
+
+    def append(self, item: Any):
+        self.size += 1
+        if self.spill is None and len(self.items) < self.max_in_memory:
+            self.items.append(item)
+            return
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile()
+        pickle.dump(item, self.spill, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __iter__(self):
+        yield from self.items
+        if self.spill is None:
+            return
+        self.spill.seek(0)
+        while True:
+            try:
+                yield pickle.load(self.spill)
+            except EOFError:
+                return
+
+
+class ResponseMemo:
+    # Remembers listings that more than one stream of the same run reads, e.g. the
+    # forms that both the forms and the submissions stream page through. Only
+    # listings that were read to the end are replayed.
+    def __init__(self, max_in_memory: int = 10_000):
+        self.max_in_memory = max_in_memory
+        self.listings: Dict[str, Listing] = {}
+
+    def replay_or_record(self, key: str, factory: Callable[[], Iterable]) -> Iterable:
+        listing = self.listings.get(key)
+        if listing is not None:
+            LOGGER.info(f"reusing {listing.size} {key} read earlier in this run")
+            yield from listing
+            return
+
+        listing = Listing(self.max_in_memory)
+        for item in factory():
+            listing.append(item)
+            yield item
+        self.listings[key] = listing
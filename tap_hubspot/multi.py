@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+from typing import Dict, List, Optional, Tuple
+
+import requests
+import singer
+
+import tap_hubspot
+from tap_hubspot.schedule import portal_cost
+from tap_hubspot.transport import create_session, pool_size
+
+LOGGER = singer.get_logger()
+
+# sessions of a worker process by pool size, reused by every portal the worker
+# syncs with that transport config so connections to api.hubapi.com stay warm
+# between portals
+SESSIONS: Dict[int, requests.Session] = {}
+
+
+class StateTrackingWriter:
+    # stands in for stdout while a portal syncs: forwards every singer message to
+    # the portal's output file and remembers the last STATE message
+    def __init__(self, out):
+        self.out = out
+        self.last_state: Optional[str] = None
+
+    def write(self, text: str):
+        if text.startswith('{"type": "STATE"'):
+            self.last_state = text
+        return self.out.write(text)
+
+    def flush(self):
+        self.out.flush()
+
+
+def worker_session(config: Dict) -> requests.Session:
+    size = pool_size(config)
+    if size not in SESSIONS:
+        SESSIONS[size] = create_session(config)
+    return SESSIONS[size]
+
+
+def discover_portals(config_dir: str) -> List[str]:
+    return sorted(
+        name[: -len(".json")]
+        for name in os.listdir(config_dir)
+        if name.endswith(".json")
+    )
+
+
+def load_json(path: str) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def sync_portal(args: Tuple[str, str, str, str]) -> Tuple[str, int]:
+    portal, config_dir, state_dir, output_dir = args
+    config = load_json(os.path.join(config_dir, f"{portal}.json"))
+    state = load_json(os.path.join(state_dir, f"{portal}.json")) if state_dir else None
+
+    exit_code = 0
+    with open(os.path.join(output_dir, f"{portal}.jsonl"), "w") as out:
+        writer = StateTrackingWriter(out)
+        with contextlib.redirect_stdout(writer):
+            try:
+                tap_hubspot.sync(config, state, session=worker_session(config))
+            except SystemExit as err:
+                exit_code = err.code if isinstance(err.code, int) else 1
+            except Exception:
+                LOGGER.exception(f"portal {portal} failed")
+                exit_code = 1
+
+    if writer.last_state:
+        message = json.loads(writer.last_state)
+        with open(os.path.join(output_dir, f"{portal}.state.json"), "w") as f:
+            json.dump(message["value"], f)
+
+    return portal, exit_code
+
+
+def run(config_dir: str, state_dir: Optional[str], output_dir: str, workers: int):
+    os.makedirs(output_dir, exist_ok=True)
+    portals = discover_portals(config_dir)
+    LOGGER.info(f"syncing {len(portals)} portals with {workers} workers")
+
+    # longest processing time first: the slowest portals start right away instead
+    # of being the last ones left running
+    if state_dir:
+        costs = {
+            portal: portal_cost(load_json(os.path.join(state_dir, f"{portal}.json")))
+            for portal in portals
+        }
+        portals.sort(key=lambda portal: costs[portal], reverse=True)
+
+    jobs = [(portal, config_dir, state_dir, output_dir) for portal in portals]
+    failed = []
+    # workers are long lived (no maxtasksperchild) so interpreter startup and
+    # imports are paid once per worker rather than once per portal. The rate
+    # limit on Hubspot.do is per process, so every portal a worker syncs gets
+    # the full budget for itself.
+    with multiprocessing.Pool(processes=workers) as pool:
+        for portal, exit_code in pool.imap_unordered(sync_portal, jobs):
+            if exit_code:
+                LOGGER.warning(f"portal {portal} exited with code {exit_code}")
+                failed.append(portal)
+            else:
+                LOGGER.info(f"portal {portal} synced")
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sync many HubSpot portals with a pool of warm worker processes"
+    )
+    parser.add_argument(
+        "--config-dir", required=True, help="directory with one <portal>.json per portal"
+    )
+    parser.add_argument("--state-dir", help="directory with <portal>.json state files")
+    parser.add_argument(
+        "--output-dir",
+        required=True,
+        help="directory for <portal>.jsonl output and <portal>.state.json state",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="number of worker processes"
+    )
+    args = parser.parse_args()
+
+    failed = run(args.config_dir, args.state_dir, args.output_dir, args.workers)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+from typing import Dict, List, Mapping, Optional
+
+import singer
+
+LOGGER = singer.get_logger()
+
+DAILY_LIMIT_HEADER = "X-HubSpot-RateLimit-Daily"
+DAILY_REMAINING_HEADER = "X-HubSpot-RateLimit-Daily-Remaining"
+
+# expensive streams that are deferred to a later run when the daily quota runs low,
+# both save their progress when they are stopped
+LOW_PRIORITY_STREAMS = ["contacts_events", "marketing_event_participations"]
+
+
+class DailyQuota:
+    # Follows the portal's daily request quota through the headers of every
+    # response. Low priority streams, and streams with a configured share, may use
+    # a share of what was left when they started and stop once only the reserve is
+    # left, so they can not use up the quota the other streams and integrations of
+    # the portal need.
+    def __init__(self, config: Dict):
+        self.low_priority = set(
+            config.get("quota_low_priority_streams", LOW_PRIORITY_STREAMS)
+        )
+        self.shares: Dict[str, float] = config.get("quota_shares", {})
+        self.low_priority_share = config.get("quota_low_priority_share", 0.25)
+        self.reserve_fraction = config.get("quota_reserve", 0.1)
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.used = 0
+        self.stream: Optional[str] = None
+        self.stream_used_from = 0
+        self.allowance: Optional[float] = None
+
+    def count_request(self):
+        self.used += 1
+
+    def observe(self, headers: Mapping[str, str]):
+        self.count_request()
+        remaining = headers.get(DAILY_REMAINING_HEADER)
+        if remaining is None:
+            return
+        self.remaining = int(remaining)
+        if headers.get(DAILY_LIMIT_HEADER):
+            self.limit = int(headers[DAILY_LIMIT_HEADER])
+
+    @property
+    def reserve(self) -> float:
+        return (self.limit or 0) * self.reserve_fraction
+
+    def share(self, stream: str) -> float:
+        default = self.low_priority_share if stream in self.low_priority else 1.0
+        return self.shares.get(stream, default)
+
+    def start_stream(self, stream: str):
+        self.stream = stream
+        self.stream_used_from = self.used
+        self.allowance = None
+        if self.remaining is not None:
+            self.allowance = max(0, self.remaining - self.reserve) * self.share(stream)
+
+    def exhausted(self) -> Optional[str]:
+        # the reason the current stream has to stop, None while it may continue
+        budgeted = self.stream in self.low_priority or self.stream in self.shares
+        if not budgeted or self.remaining is None:
+            return None
+        if self.remaining <= self.reserve:
+            return f"{self.remaining} of {self.limit} daily requests left, deferring {self.stream}"
+        used = self.used - self.stream_used_from
+        if self.allowance is not None and used >= self.allowance:
+            return f"{self.stream} used its share of {int(self.allowance)} daily requests"
+        return None
+
+    def log_projection(self, stats: Dict[str, Dict], streams: List[str]):
+        known = [name for name in streams if name in stats]
+        projected = sum(stats[name].get("requests", 0) for name in known)
+        message = f"projected quota use: {projected} requests for {len(known)} of {len(streams)} streams"
+        if self.remaining is not None:
+            message += f", {self.remaining} of {self.limit} daily requests left"
+            if projected > self.remaining - self.reserve:
+                LOGGER.warning(f"{message}, low priority streams may be deferred")
+                return
+        LOGGER.info(message)
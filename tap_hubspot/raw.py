@@ -0,0 +1,116 @@
+import json
+import re
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+import singer
+
+DECODER = json.JSONDecoder()
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class RawRecord(dict):
+    # a decoded record that keeps the exact JSON text it was decoded from, so it
+    # can be written without encoding it again. Only for records the tap does
+    # not modify.
+    __slots__ = ("raw",)
+
+
+def skip_whitespace(text: str, idx: int) -> int:
+    return WHITESPACE.match(text, idx).end()
+
+
+def char_at(text: str, idx: int) -> str:
+    # empty and truncated responses fail like json.loads does
+    if idx >= len(text):
+        raise ValueError(f"unexpected end of JSON input at position {idx}")
+    return text[idx]
+
+
+def decode_array(text: str, idx: int) -> Tuple[List[Any], int]:
+    # raw_decode returns where each element ends, which gives the raw text of
+    # every record without a separate pass over the response
+    if char_at(text, idx) != "[":
+        raise ValueError(f"expected a JSON array at position {idx}")
+    records: List[Any] = []
+    idx = skip_whitespace(text, idx + 1)
+    if char_at(text, idx) == "]":
+        return records, idx + 1
+    while True:
+        start = idx
+        value, idx = DECODER.raw_decode(text, idx)
+        if isinstance(value, dict):
+            value = RawRecord(value)
+            value.raw = text[start:idx]
+        records.append(value)
+
+        idx = skip_whitespace(text, idx)
+        if char_at(text, idx) == ",":
+            idx = skip_whitespace(text, idx + 1)
+            continue
+        if char_at(text, idx) == "]":
+            return records, idx + 1
+        raise ValueError(f"expected ',' or ']' at position {idx}")
+
+
+def expect_end(text: str, idx: int):
+    # data after the document is an error, as in json.loads
+    idx = skip_whitespace(text, idx)
+    if idx != len(text):
+        raise ValueError(f"extra data at position {idx}")
+
+
+def decode_response(text: str, data_field: Optional[str]) -> Any:
+    # decodes a list response like json.loads, except that the records in
+    # data_field (or the top level list) are RawRecords
+    idx = skip_whitespace(text, 0)
+    if not data_field:
+        records, idx = decode_array(text, idx)
+        expect_end(text, idx)
+        return records
+
+    document, idx = decode_document(text, idx, data_field)
+    expect_end(text, idx)
+    return document
+
+
+def decode_document(text: str, idx: int, data_field: str) -> Tuple[Dict[str, Any], int]:
+    if char_at(text, idx) != "{":
+        raise ValueError("expected a JSON object")
+    document: Dict[str, Any] = {}
+    idx = skip_whitespace(text, idx + 1)
+    if char_at(text, idx) == "}":
+        return document, idx + 1
+    while True:
+        key, idx = DECODER.raw_decode(text, idx)
+        if not isinstance(key, str):
+            raise ValueError(f"expected a key at position {idx}")
+        idx = skip_whitespace(text, idx)
+        if char_at(text, idx) != ":":
+            raise ValueError(f"expected ':' at position {idx}")
+        idx = skip_whitespace(text, idx + 1)
+
+        if key == data_field and char_at(text, idx) == "[":
+            document[key], idx = decode_array(text, idx)
+        else:
+            document[key], idx = DECODER.raw_decode(text, idx)
+
+        idx = skip_whitespace(text, idx)
+        if char_at(text, idx) == ",":
+            idx = skip_whitespace(text, idx + 1)
+            continue
+        if char_at(text, idx) == "}":
+            return document, idx + 1
+        raise ValueError(f"expected ',' or '}}' at position {idx}")
+
+
+def write_record(stream_name: str, record: Dict):
+    raw = getattr(record, "raw", None)
+    # a record spanning several lines would break the line based singer protocol
+    if raw is None or "\n" in raw:
+        singer.write_record(stream_name, record)
+        return
+    sys.stdout.write(
+        f'{{"type": "RECORD", "stream": {json.dumps(stream_name)}, "record": {raw}}}\n'
+    )
+    sys.stdout.flush()
@@ -0,0 +1,192 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set, TypeVar
+
+import ratelimit
+import requests
+import singer
+from singer import metrics
+
+LOGGER = singer.get_logger()
+
+T = TypeVar("T")
+
+
+class CircuitOpen(Exception):
+    # too many requests to the endpoint failed recently, it is not called until
+    # the cooldown has passed
+    pass
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    # the delay the server (or the local rate limit) asks for, if any
+    if isinstance(e, ratelimit.RateLimitException):
+        return e.period_remaining
+    if not isinstance(e, requests.HTTPError) or e.response is None:
+        return None
+    if e.response.status_code not in (429, 503):
+        return None
+    value = e.response.headers.get("Retry-After")
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_endpoint_failure(e: Exception) -> bool:
+    # failures that say something about the endpoint's health, unlike rate limits
+    # and client errors
+    if isinstance(e, (requests.Timeout, requests.ConnectionError)):
+        return True
+    return (
+        isinstance(e, requests.HTTPError)
+        and e.response is not None
+        and e.response.status_code >= 500
+    )
+
+
+class CircuitBreaker:
+    # Keeps the outcomes of the last window requests per endpoint template. The
+    # circuit opens when at least min_requests were made and error_rate of them
+    # failed, and lets one request through again after cooldown seconds.
+    def __init__(
+        self,
+        window: int = 20,
+        min_requests: int = 10,
+        error_rate: float = 0.5,
+        cooldown: float = 60,
+    ):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.outcomes: Dict[str, Deque[bool]] = {}
+        self.opened_at: Dict[str, float] = {}
+        self.half_open: Set[str] = set()
+        self.lock = threading.Lock()
+
+    def before_call(self, template: str):
+        with self.lock:
+            opened_at = self.opened_at.get(template)
+            if opened_at is None:
+                return
+            if time.monotonic() - opened_at < self.cooldown:
+                raise CircuitOpen(template)
+            # half open: the next outcome decides whether the circuit closes
+            del self.opened_at[template]
+            self.half_open.add(template)
+
+    def record(self, template: str, failed: bool):
+        with self.lock:
+            if template in self.half_open:
+                self.half_open.discard(template)
+                if failed:
+                    LOGGER.warning(f"{template} is still failing, pausing it for {self.cooldown}s")
+                    self.opened_at[template] = time.monotonic()
+                else:
+                    self.outcomes.pop(template, None)
+                return
+            outcomes = self.outcomes.setdefault(template, deque(maxlen=self.window))
+            outcomes.append(failed)
+            if template in self.opened_at or len(outcomes) < self.min_requests:
+                return
+            if sum(outcomes) / len(outcomes) >= self.error_rate:
+                LOGGER.warning(
+                    f"{sum(outcomes)} of the last {len(outcomes)} requests to {template} failed, pausing it for {self.cooldown}s"
+                )
+                self.opened_at[template] = time.monotonic()
+
+
+class RetryPolicy:
+    # Retries failed requests with exponential backoff and full jitter, except
+    # that delays asked for with Retry-After (or by the local rate limit) are
+    # waited exactly. Gives up after max_tries or once max_time would be exceeded.
+    def __init__(
+        self,
+        giveup: Callable[[Exception], bool],
+        breaker: CircuitBreaker,
+        max_tries: int = 10,
+        max_time: float = 5 * 60,
+        max_delay: float = 60,
+    ):
+        self.giveup = giveup
+        self.breaker = breaker
+        self.max_tries = max_tries
+        self.max_time = max_time
+        self.max_delay = max_delay
+        self.retry_seconds: Dict[str, float] = {}
+
+    def call(self, template: str, request: Callable[[], T]) -> T:
+        # requests already retrying are not cut short when the circuit opens
+        self.breaker.before_call(template)
+        started = time.monotonic()
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                result = request()
+            except Exception as e:
+                time.sleep(self.backoff(template, e, tries, started))
+                continue
+            self.breaker.record(template, failed=False)
+            return result
+
+    async def call_async(self, template: str, request: Callable[[], Awaitable[T]]) -> T:
+        # the same for the asyncio client, which raises the exceptions of requests
+        self.breaker.before_call(template)
+        started = time.monotonic()
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                result = await request()
+            except Exception as e:
+                await asyncio.sleep(self.backoff(template, e, tries, started))
+                continue
+            self.breaker.record(template, failed=False)
+            return result
+
+    def backoff(self, template: str, e: Exception, tries: int, started: float) -> float:
+        # the delay before the next try, re-raises e when there is none
+        if not self.is_retryable(e):
+            raise e
+        if is_endpoint_failure(e):
+            self.breaker.record(template, failed=True)
+
+        delay = retry_after(e)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, 2**tries))
+        elapsed = time.monotonic() - started
+        if tries >= self.max_tries or elapsed + delay > self.max_time:
+            LOGGER.error(f"giving up on {template} after {tries} tries ({e!r})")
+            raise e
+        LOGGER.info(f"backing off {template} for {delay:.1f}s after {tries} tries ({e!r})")
+        self.retry_seconds[template] = self.retry_seconds.get(template, 0) + delay
+        return delay
+
+    def is_retryable(self, e: Exception) -> bool:
+        from tap_hubspot.hubspot import RetryAfterReauth
+
+        retryable = (
+            requests.RequestException,
+            ratelimit.RateLimitException,
+            RetryAfterReauth,
+        )
+        return isinstance(e, retryable) and not self.giveup(e)
+
+    def log_metrics(self):
+        for template, seconds in sorted(self.retry_seconds.items()):
+            metrics.log(
+                LOGGER,
+                metrics.Point(
+                    "timer", "retry_duration", round(seconds, 1), {"endpoint": template}
+                ),
+            )
@@ -0,0 +1,112 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set
+
+from dateutil import parser
+
+from tap_hubspot.models import Table
+
+# streams that read what another stream of the same run left in event_state
+STREAM_DEPENDENCIES: Dict[str, List[str]] = {
+    # the ids and the time window of the synced contacts
+    "contacts_events": ["contacts"],
+    # the form guids found on contacts, and the forms
+    "submissions": ["contacts", "forms"],
+    "contacts_in_contact_lists": ["contact_lists"],
+    "marketing_event_participations": ["marketing_events"],
+}
+
+
+def record_stream_stats(
+    state: Optional[dict],
+    stream: str,
+    duration: float,
+    requests: int,
+    records: int,
+    now: Optional[datetime] = None,
+) -> dict:
+    state = state or {}
+    now = now or datetime.now(timezone.utc)
+    state.setdefault("stream_stats", {})[stream] = {
+        "duration": round(duration, 1),
+        "requests": requests,
+        "records": records,
+        "last_synced": now.isoformat(),
+    }
+    return state
+
+
+def hours_since_sync(stats: Dict, now: datetime) -> Optional[float]:
+    if not stats.get("last_synced"):
+        return None
+    return (now - parser.isoparse(stats["last_synced"])).total_seconds() / 3600
+
+
+def order_tables(
+    tables: List[Table],
+    state: Optional[dict],
+    by_cost: bool = False,
+    starvation_hours: float = 24,
+    now: Optional[datetime] = None,
+) -> List[Table]:
+    # Streams a previous run did not finish go first, then streams that were not
+    # synced for starvation_hours. With by_cost the rest are ordered by their last
+    # duration, discounted by how long ago they were synced, so cheap and stale
+    # streams come first. Dependencies between streams are kept either way.
+    state = state or {}
+    now = now or datetime.now(timezone.utc)
+    unfinished = {
+        name: i for i, name in enumerate(state.get("unfinished_streams") or [])
+    }
+    all_stats = state.get("stream_stats") or {}
+
+    def priority(position: int, table: Table):
+        if table.name in unfinished:
+            return (0, unfinished[table.name], 0)
+        if not by_cost:
+            return (2, position, 0)
+        stats = all_stats.get(table.name)
+        if not stats:
+            # never measured, probably a new stream
+            return (2, 0, position)
+        staleness = hours_since_sync(stats, now) or 0
+        if staleness >= starvation_hours:
+            return (1, -staleness, position)
+        return (2, stats.get("duration", 0) / (1 + staleness), position)
+
+    preferred = [
+        table
+        for position, table in sorted(
+            enumerate(tables), key=lambda item: priority(*item)
+        )
+    ]
+    return respect_dependencies(preferred)
+
+
+def respect_dependencies(tables: List[Table]) -> List[Table]:
+    # keeps the preferred order, except that the streams a stream depends on are
+    # moved right before it
+    by_name = {table.name: table for table in tables}
+    ordered: List[Table] = []
+    done: Set[str] = set()
+
+    def visit(table: Table, path: Set[str]):
+        if table.name in done or table.name in path:
+            return
+        for dependency in STREAM_DEPENDENCIES.get(table.name, []):
+            if dependency in by_name:
+                visit(by_name[dependency], path | {table.name})
+        done.add(table.name)
+        ordered.append(table)
+
+    for table in tables:
+        visit(table, set())
+    return ordered
+
+
+def portal_cost(state: Optional[dict]) -> float:
+    # the duration of the portal's last run, portals without stats are assumed to
+    # be expensive first syncs
+    stats = (state or {}).get("stream_stats")
+    if not stats:
+        return float("inf")
+    return sum(stream.get("duration", 0) for stream in stats.values())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+import json
+import re
+import sys
+from collections import defaultdict
+from typing import DefaultDict, Dict, List, Optional, Tuple
+
+import singer
+from dateutil import parser
+
+LOGGER = singer.get_logger()
+
+SHARD_KEY_PATTERN = re.compile(r"^(?P<stream>.+)@shard(?P<index>\d+)of(?P<count>\d+)$")
+
+
+class Shard:
+    def __init__(self, index: int, count: int):
+        if count < 1 or not (0 <= index < count):
+            raise ValueError(f"invalid shard {index}/{count}, expected 0 <= i < n")
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, value: str) -> "Shard":
+        try:
+            index, count = value.split("/")
+            return cls(int(index), int(count))
+        except ValueError:
+            raise ValueError(f"invalid shard '{value}', expected 'i/n' e.g. '0/4'")
+
+    def state_key(self, tap_stream_id: str) -> str:
+        return f"{tap_stream_id}@shard{self.index}of{self.count}"
+
+    def bounds(self, max_id: int) -> Tuple[int, Optional[int]]:
+        # lower bound is inclusive, upper bound exclusive. The last shard is left
+        # open so objects created after max_id was determined still land somewhere.
+        width = max_id // self.count + 1
+        lower = self.index * width
+        if self.index == self.count - 1:
+            return lower, None
+        return lower, (self.index + 1) * width
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+
+def round_max_id(max_id: int) -> int:
+    # shards running on different machines probe the max id at slightly different
+    # times. Rounding up to the leading digit keeps the partition identical unless
+    # the portal crosses a boundary in between, e.g. 123456789 -> 200000000. The
+    # shards keep the max id in their state and merge_states refuses to merge
+    # shards that used different ones.
+    if max_id < 10:
+        return 10
+    magnitude = 10 ** (len(str(max_id)) - 1)
+    return (max_id // magnitude + 1) * magnitude
+
+
+def is_first_shard(state: Dict) -> bool:
+    for key in state.get("bookmarks", {}):
+        match = SHARD_KEY_PATTERN.match(key)
+        if match and match.group("index") == "0":
+            return True
+    return False
+
+
+def merge_states(states: List[Dict]) -> Dict:
+    # the state of shard 0 carries the streams that are not sharded
+    base = next((state for state in states if is_first_shard(state)), states[0])
+    merged = copy.deepcopy(base)
+    merged_bookmarks = merged.setdefault("bookmarks", {})
+
+    shards: DefaultDict = defaultdict(dict)
+    for state in states:
+        bookmarks = state.get("bookmarks", {})
+        for key, bookmark in bookmarks.items():
+            match = SHARD_KEY_PATTERN.match(key)
+            if not match:
+                continue
+            stream = match.group("stream")
+            count = int(match.group("count"))
+            # a shard that saw no records keeps the bookmark it started from
+            effective = dict(bookmarks.get(stream, {}))
+            effective.update(bookmark)
+            shards[(stream, count)][int(match.group("index"))] = effective
+
+    for (stream, count), bookmarks in shards.items():
+        if len(bookmarks) != count:
+            LOGGER.warning(
+                f"only {len(bookmarks)} of {count} shards have a bookmark for {stream}, not merging"
+            )
+            continue
+        # shards that split the ids by different max ids left ranges that no shard
+        # read, their bookmarks do not cover the stream
+        max_ids = {bookmark.get("shard_max_id") for bookmark in bookmarks.values()}
+        if len(max_ids) > 1:
+            raise ValueError(
+                f"the shards of {stream} were split by different max ids {sorted(max_ids, key=str)}, "
+                f"pin them with shard_max_ids and sync the shards again"
+            )
+
+        # every shard has synced up to its own bookmark, so together they are
+        # complete up to the smallest one
+        result: Dict = {}
+        keys = set().union(*bookmarks.values())
+        for key in keys:
+            values = [bookmark.get(key) for bookmark in bookmarks.values()]
+            if any(value is None for value in values):
+                continue
+            try:
+                result[key] = min(values, key=parser.isoparse)
+            except (TypeError, ValueError):
+                result[key] = values[0]
+        merged_bookmarks[stream] = result
+        for index in range(count):
+            merged_bookmarks.pop(f"{stream}@shard{index}of{count}", None)
+
+    return merged
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Merge the states of a sharded sync into a single state"
+    )
+    arg_parser.add_argument("states", nargs="+", help="state file of every shard")
+    args = arg_parser.parse_args()
+
+    states = []
+    for path in args.states:
+        with open(path) as f:
+            states.append(json.load(f))
+
+    try:
+        merged = merge_states(states)
+    except ValueError as err:
+        LOGGER.critical(err)
+        sys.exit(1)
+    json.dump(merged, sys.stdout)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+from typing import List, Sequence, Tuple
+
+# [start, end) in epoch milliseconds
+Slice = Tuple[int, int]
+
+
+def time_slices(start: int, end: int, size: int) -> List[Slice]:
+    # Slices are aligned to multiples of size, so the slices of a later run with a
+    # different start line up with the ones a previous run completed.
+    slices = []
+    lower = start
+    while lower < end:
+        upper = min(end, (lower // size + 1) * size)
+        slices.append((lower, upper))
+        lower = upper
+    return slices
+
+
+def is_covered(time_slice: Slice, completed: Sequence[Sequence[int]]) -> bool:
+    return any(lower <= time_slice[0] and time_slice[1] <= upper for lower, upper in completed)
+
+
+def frontier(start: int, completed: Sequence[Sequence[int]]) -> int:
+    # the end of the completed slices that follow start without a gap
+    done_until = start
+    for lower, upper in sorted(completed):
+        if lower > done_until:
+            break
+        done_until = max(done_until, upper)
+    return done_until
@@ -1,46 +1,183 @@
+import hashlib
+import json
 import singer
-from typing import DefaultDict, Set, Union, Dict
+from typing import Any, DefaultDict, Set, Union, Dict, Optional, Iterable, List, Tuple
 from datetime import timedelta, datetime
 from dateutil import parser
-from tap_hubspot.hubspot import Hubspot
+from tap_hubspot.cache import FingerprintIndex
+from tap_hubspot.hubspot import BudgetExhausted, Hubspot, NotModified
+from tap_hubspot.raw import RawRecord, write_record
+from tap_hubspot.retry import CircuitOpen
+from tap_hubspot.slices import frontier
 import pytz
 
 LOGGER = singer.get_logger()
 
 
+# small streams that rarely change, skipped when nothing changed since the last run
+REFERENCE_STREAMS = ["owners", "deal_pipelines", "forms", "users_teams"]
+
+
 class Replication:
     key = "replication_method"
     full_table = "FULL_TABLE"  # means we replace all records in the table
     incremental = "INCREMENTAL"  # means we append new records to the table
 
 
+def records_digest(records: List[Tuple[Dict, Any]]) -> str:
+    digest = hashlib.sha256()
+    for record, _ in records:
+        digest.update(json.dumps(record, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def drop_empty_values(record: Dict, drop_empty_associations: bool) -> Dict:
+    # search results echo every requested property, most of them null
+    properties = record.get("properties")
+    if isinstance(properties, dict):
+        record["properties"] = {
+            key: value
+            for key, value in properties.items()
+            if value is not None and value != ""
+        }
+
+    associations = record.get("associations")
+    if drop_empty_associations and isinstance(associations, dict):
+        record["associations"] = {
+            key: value for key, value in associations.items() if value.get("results")
+        }
+    return record
+
+
 class Stream:
     def __init__(
         self,
         config: Dict,
         tap_stream_id: str,
         bookmark_key: str,
+        state_key: Optional[str] = None,
+        fingerprints: Optional[FingerprintIndex] = None,
     ):
         self.tap_stream_id = tap_stream_id
         self.bookmark_key = bookmark_key
         self.config = config
+        # sharded syncs keep their bookmarks under their own key in the state
+        self.state_key = state_key or tap_stream_id
+        self.sparse_records = config.get("sparse_records", False)
+        self.sparse_associations = config.get("sparse_associations", False)
+        self.fingerprints = fingerprints
+        self.skip_unchanged = config.get("skip_unchanged_reference_streams", False)
+        # records read by the last do_sync, including unchanged ones
+        self.record_count = 0
 
-    def sync_properties(self, hubspot: Hubspot):
+    def sync_properties(self, hubspot: Hubspot, state: Optional[dict] = None):
         table_name = f"{self.tap_stream_id}_properties"
         data = hubspot.get_properties(self.tap_stream_id)
-        for record, _ in data:
-            singer.write_record(table_name, record)
-        return
+        if not self.skip_unchanged:
+            for record, _ in data:
+                write_record(table_name, record)
+            return state
+
+        records, digest = self.read_if_changed(hubspot, table_name, data, state)
+        for record, _ in records:
+            write_record(table_name, record)
+        if digest:
+            state = self.write_digest(hubspot, table_name, digest, state)
+            singer.write_state(state)
+        return state
+
+    def read_if_changed(
+        self,
+        hubspot: Hubspot,
+        state_key: str,
+        data: Iterable[Tuple[Dict, Any]],
+        state: Optional[dict],
+    ) -> Tuple[List[Tuple[Dict, Any]], Optional[str]]:
+        account_record = ((state or {}).get("bookmarks") or {}).get(state_key) or {}
+        hubspot.etags = account_record.get("etags", {})
+        hubspot.response_etags = {}
+        try:
+            records = list(data)
+        except NotModified:
+            LOGGER.info(f"{state_key} is not modified since the last run, skipping")
+            return [], None
+        finally:
+            hubspot.etags = {}
+
+        digest = records_digest(records)
+        if digest == account_record.get("digest"):
+            LOGGER.info(f"{state_key} is unchanged since the last run, skipping")
+            return [], None
+        return records, digest
+
+    def write_digest(
+        self, hubspot: Hubspot, state_key: str, digest: str, state: Optional[dict]
+    ) -> dict:
+        state = singer.write_bookmark(state or {}, state_key, "digest", digest)
+        return singer.write_bookmark(
+            state, state_key, "etags", dict(hubspot.response_etags)
+        )
 
     def do_sync(self, hubspot: Hubspot, is_custom_object: bool, state: dict):
         prev_bookmark = None
         start_date, end_date = self.__get_start_end(state)
+        bookmark = self.__get_bookmark(state)
+        first_sync = bookmark is None
+        # a search stopped by the runtime budget continues where it stopped, in the
+        # same window, and keeps the bookmark until the window is done
+        resume = self.__get_resume(state)
+        hubspot.resume_after = None
+        if resume:
+            start_date = parser.isoparse(resume["start"])
+            end_date = parser.isoparse(resume["end"])
+            hubspot.resume_after = resume["after_id"]
+            if resume.get("bookmark"):
+                prev_bookmark = parser.isoparse(resume["bookmark"])
+            LOGGER.info(
+                f"resuming {self.tap_stream_id} from {start_date} to {end_date} after id {resume['after_id']}"
+            )
+        last_id = None
+        keep_bookmark = False
+        sharded = self.state_key != self.tap_stream_id
+        if sharded:
+            shard_max_id = self.__get_shard_max_id(state)
+            if shard_max_id is not None:
+                hubspot.shard_max_ids[self.tap_stream_id] = shard_max_id
+        if self.tap_stream_id == "contacts":
+            account_record = self.__get_account_record(state) or {}
+            hubspot.event_state["contacts_pending_tracking_ids"] = account_record.get(
+                "pending_tracking_ids", []
+            )
+
+        if self.tap_stream_id == "contacts_events":
+            account_record = self.__get_account_record(state) or {}
+            hubspot.event_state["contacts_events_pending_ids"] = account_record.get(
+                "pending_ids", []
+            )
+
+        if self.tap_stream_id == "marketing_event_participations":
+            account_record = self.__get_account_record(state) or {}
+            hubspot.event_state["marketing_event_participations_done"] = list(
+                account_record.get("completed_event_ids", [])
+            )
+
+        if self.tap_stream_id == "email_events":
+            account_record = self.__get_account_record(state) or {}
+            hubspot.event_state["email_events_completed_slices"] = account_record.get(
+                "completed_slices", []
+            )
 
         replication_method = Replication.incremental
         completed_successfully = False
         if self.tap_stream_id in ["contacts_in_contact_lists"]:
             replication_method = Replication.full_table
 
+        # a full table stream has to emit every record, even unchanged ones
+        fingerprints = (
+            self.fingerprints if replication_method == Replication.incremental else None
+        )
+        unchanged = 0
+
         with singer.metrics.record_counter(self.tap_stream_id) as counter:
             try:
                 data = hubspot.streams(
@@ -48,13 +185,33 @@ class Stream:
                     end_date=end_date,
                     tap_stream_id=self.tap_stream_id,
                     is_custom_object=is_custom_object,
+                    first_sync=first_sync,
                 )
+                digest = None
+                if self.skip_unchanged and self.tap_stream_id in REFERENCE_STREAMS:
+                    data, digest = self.read_if_changed(
+                        hubspot, self.state_key, data, state
+                    )
                 for record, replication_value in data:
+                    self.record_count += 1
+                    if self.sparse_records and not isinstance(record, RawRecord):
+                        record = drop_empty_values(record, self.sparse_associations)
 
-                    singer.write_record(self.tap_stream_id, record)
-                    counter.increment(1)
-                    if not replication_value:
+                    entry = (
+                        fingerprints.fingerprint(self.tap_stream_id, record)
+                        if fingerprints
+                        else None
+                    )
+                    if entry and fingerprints.is_unchanged(entry):
+                        unchanged += 1
+                    else:
+                        write_record(self.tap_stream_id, record)
+                        counter.increment(1)
+                    if entry:
+                        fingerprints.remember(entry)
+                    if not replication_value or hubspot.read_changed_ids:
                         continue
+                    last_id = record.get("id")
 
                     new_bookmark = replication_value
                     if not prev_bookmark:
@@ -64,12 +221,35 @@ class Stream:
                         state = self.__advance_bookmark(state, prev_bookmark, replication_method)
                         prev_bookmark = new_bookmark
                 completed_successfully = True
+                # only once every record is emitted, a run that crashed before
+                # emits them again
+                if digest:
+                    state = self.write_digest(hubspot, self.state_key, digest, state)
+                if unchanged:
+                    LOGGER.info(f"skipped {unchanged} unchanged {self.tap_stream_id}")
+                if resume:
+                    state.get("bookmarks", {}).get(self.state_key, {}).pop("resume", None)
                 return self.output_state(
                     state=state,
                     prev_bookmark=prev_bookmark,
                     event_state=hubspot.event_state,
                     replication_method=replication_method,
                 )
+            except (BudgetExhausted, CircuitOpen):
+                # stopped by the budget or a failing endpoint. Search results are
+                # sorted by id, so the bookmark can only move once the whole window
+                # is read
+                keep_bookmark = True
+                if hubspot.searched and (last_id or resume):
+                    state = self.save_resume_cursor(
+                        state, bookmark, resume, start_date, end_date, last_id, prev_bookmark
+                    )
+                else:
+                    # other listings are not sorted by the bookmark, they are read
+                    # again from the previous bookmark
+                    state = self.restore_bookmark(state, bookmark)
+                    singer.write_state(state)
+                raise
 
             finally:
                 if (
@@ -77,7 +257,113 @@ class Stream:
                     and replication_method == Replication.full_table
                 ):
                     replication_method = Replication.incremental
-                self.__advance_bookmark(state, prev_bookmark, replication_method)
+                if not completed_successfully and self.tap_stream_id == "email_events":
+                    state, slices_bookmark = self.save_slice_progress(
+                        state, hubspot.event_state
+                    )
+                    if slices_bookmark:
+                        prev_bookmark = slices_bookmark
+                        keep_bookmark = False
+                if self.tap_stream_id == "contacts_events":
+                    state = self.save_pending_contact_ids(
+                        state, hubspot.event_state, completed_successfully
+                    )
+                if self.tap_stream_id == "marketing_event_participations":
+                    # a stopped run continues with the events it did not read
+                    done = hubspot.event_state.get("marketing_event_participations_done")
+                    state = singer.write_bookmark(
+                        state or {},
+                        self.state_key,
+                        "completed_event_ids",
+                        [] if completed_successfully else list(done or []),
+                    )
+                if sharded and self.tap_stream_id in hubspot.shard_max_ids:
+                    state = singer.write_bookmark(
+                        state or {},
+                        self.state_key,
+                        "shard_max_id",
+                        hubspot.shard_max_ids[self.tap_stream_id],
+                    )
+                if not keep_bookmark:
+                    self.__advance_bookmark(state, prev_bookmark, replication_method)
+
+    def save_resume_cursor(
+        self,
+        state: dict,
+        bookmark: Optional[str],
+        resume: Optional[Dict],
+        start_date: datetime,
+        end_date: datetime,
+        last_id: Optional[str],
+        prev_bookmark: Optional[datetime],
+    ) -> dict:
+        if last_id:
+            resume = {
+                "start": start_date.isoformat(),
+                "end": end_date.isoformat(),
+                "after_id": str(last_id),
+                "bookmark": prev_bookmark.isoformat() if prev_bookmark else None,
+            }
+        LOGGER.info(f"{self.tap_stream_id} stopped after id {resume['after_id']}")
+        state = self.restore_bookmark(state, bookmark)
+        state = singer.write_bookmark(state, self.state_key, "resume", resume)
+        singer.write_state(state)
+        return state
+
+    def restore_bookmark(self, state: Optional[dict], bookmark: Optional[str]) -> dict:
+        # the bookmark may have moved while the records were read
+        state = state or {}
+        account_record = state.setdefault("bookmarks", {}).setdefault(self.state_key, {})
+        if bookmark:
+            account_record[self.bookmark_key] = bookmark
+        else:
+            account_record.pop(self.bookmark_key, None)
+        return state
+
+    def save_slice_progress(
+        self, state: dict, event_state: Dict
+    ) -> Tuple[dict, Optional[datetime]]:
+        # the bookmark of a stream read in time slices is the end of the slices
+        # completed without a gap, the slices completed after a gap are kept so the
+        # next run skips them
+        start = event_state.get("email_events_start")
+        if start is None:
+            return state, None
+        completed = event_state.get("email_events_completed_slices") or []
+        done_until = frontier(start, completed)
+        state = singer.write_bookmark(
+            state or {},
+            self.state_key,
+            "completed_slices",
+            sorted(time_slice for time_slice in completed if time_slice[1] > done_until),
+        )
+        if done_until == start:
+            return state, None
+        return state, datetime.fromtimestamp(done_until / 1000, pytz.utc)
+
+    def save_pending_contact_ids(
+        self, state: Optional[dict], event_state: Dict, completed: bool
+    ) -> dict:
+        # the contacts whose events were not read yet. They are not in the window of
+        # the next run's contacts, so they are carried over in the state
+        if completed:
+            pending = []
+        elif "contacts_events_queue" in event_state:
+            queue = event_state["contacts_events_queue"]
+            pending = queue[event_state["contacts_events_done"] :]
+        else:
+            account_record = self.__get_account_record(state) or {}
+            pending = list(
+                dict.fromkeys(
+                    [
+                        *account_record.get("pending_ids", []),
+                        *event_state["contacts_events_ids"],
+                    ]
+                )
+            )
+        if pending:
+            LOGGER.info(f"events of {len(pending)} contacts are left for the next run")
+        return singer.write_bookmark(state or {}, self.state_key, "pending_ids", pending)
 
     def output_state(self, state, prev_bookmark, event_state, replication_method):
 
@@ -86,6 +372,19 @@ class Stream:
         ]:
             date_source = self.tap_stream_id.split("_")[0]
             prev_bookmark = event_state[f"{date_source}_end_date"]
+        if self.tap_stream_id == "email_events":
+            state, slices_bookmark = self.save_slice_progress(state, event_state)
+            prev_bookmark = slices_bookmark or prev_bookmark
+
+        if self.tap_stream_id == "contacts" and self.config.get(
+            "contacts_tracking_refetch"
+        ):
+            state = singer.write_bookmark(
+                state,
+                self.state_key,
+                "pending_tracking_ids",
+                sorted(event_state["contacts_pending_tracking_ids_next"], key=int),
+            )
 
         return self.__advance_bookmark(state, prev_bookmark, replication_method)
 
@@ -99,16 +398,7 @@ class Stream:
         else:
             config_start_date = datetime.utcnow() + timedelta(weeks=4)
 
-        if not state:
-            LOGGER.info(f"using 'start_date' from config: {config_start_date}")
-            return config_start_date, end_date
-
-        account_record = state["bookmarks"].get(self.tap_stream_id, None)
-        if not account_record:
-            LOGGER.info(f"using 'start_date' from config: {config_start_date}")
-            return config_start_date, end_date
-
-        current_bookmark = account_record.get(self.bookmark_key, None)
+        current_bookmark = self.__get_bookmark(state)
         if not current_bookmark:
             LOGGER.info(f"using 'start_date' from config: {config_start_date}")
             return config_start_date, end_date
@@ -119,15 +409,54 @@ class Stream:
         ]:
             # tracking data sync is dependent on contacts sync
             # hubspot does not return tracking data for contacts that are recently created
-            # we need to always rewind 1 day to fetch the contacts
-
-            start_date = start_date - timedelta(days=1)
+            # we rewind 1 day to fetch the contacts again, unless the contacts emitted
+            # without tracking data are refetched by id
+            default_lookback = 0 if self.config.get("contacts_tracking_refetch") else 24
+            lookback_hours = self.config.get("contacts_lookback_hours", default_lookback)
+            start_date = start_date - timedelta(hours=lookback_hours)
         LOGGER.info(f"using 'start_date' from previous state: {start_date}")
         return start_date, end_date
 
+    def __get_bookmark(self, state: dict) -> Optional[str]:
+        account_record = self.__get_account_record(state)
+        if not account_record:
+            return None
+
+        return account_record.get(self.bookmark_key, None)
+
+    def __get_shard_max_id(self, state: dict) -> Optional[int]:
+        # a merged state keeps the max id under the stream's own key
+        bookmarks = (state or {}).get("bookmarks", {})
+        for key in (self.state_key, self.tap_stream_id):
+            max_id = bookmarks.get(key, {}).get("shard_max_id")
+            if max_id is not None:
+                return int(max_id)
+        return None
+
+    def __get_account_record(self, state: dict) -> Optional[dict]:
+        if not state:
+            return None
+
+        # a run stopped before any stream wrote a bookmark leaves a state without them
+        bookmarks = state.get("bookmarks", {})
+        account_record = bookmarks.get(self.tap_stream_id, None)
+        shard_record = bookmarks.get(self.state_key, None)
+        if shard_record and (
+            shard_record.get(self.bookmark_key) or shard_record.get("resume")
+        ):
+            account_record = shard_record
+        return account_record
+
+    def __get_resume(self, state: Optional[dict]) -> Optional[Dict]:
+        # the cursor is always kept under the stream's own state key, a sharded
+        # first sync has no bookmark to tell its record apart
+        return ((state or {}).get("bookmarks", {}).get(self.state_key) or {}).get(
+            "resume"
+        )
+
     def __advance_bookmark(self, state: dict, bookmark: Union[str, datetime, None], replication_method: str):
         if not bookmark:
-            state = singer.write_bookmark(state, self.tap_stream_id, Replication.key, replication_method)
+            state = singer.write_bookmark(state, self.state_key, Replication.key, replication_method)
             singer.write_state(state)
             return state
 
@@ -141,11 +470,11 @@ class Stream:
             )
 
         state = singer.write_bookmark(
-            state, self.tap_stream_id, self.bookmark_key, bookmark_datetime.isoformat()
+            state, self.state_key, self.bookmark_key, bookmark_datetime.isoformat()
         )
 
         state = singer.write_bookmark(
-            state, self.tap_stream_id, Replication.key, replication_method
+            state, self.state_key, Replication.key, replication_method
         )
         singer.write_state(state)
         return state
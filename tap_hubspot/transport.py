@@ -0,0 +1,128 @@
+import re
+import socket
+from typing import Dict, Tuple
+from urllib.parse import urlsplit
+
+import requests
+import singer
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+LOGGER = singer.get_logger()
+
+# path fragments of endpoints that answer with large pages or take long to
+# compute them, everything else is metadata
+SEARCH_ENDPOINTS = ("/search", "/batch/read", "/exports/")
+
+# numeric ids, guids and hex ids in request paths
+ID_SEGMENT = re.compile(r"\d+|[0-9a-fA-F]{8}-[0-9a-fA-F-]{27}|[0-9a-fA-F]{24,}")
+
+# probes start after a minute of idle, so connections idling between pages or
+# portals are not dropped by NAT gateways and load balancers
+KEEPALIVE_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)] + [
+    (socket.IPPROTO_TCP, getattr(socket, name), value)
+    for name, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 20), ("TCP_KEEPCNT", 5))
+    if hasattr(socket, name)
+]
+
+
+class TransportAdapter(HTTPAdapter):
+    # an adapter with keep-alive sockets that counts how many responses arrived
+    # compressed. A session reused across portals is counted from the last reset.
+    def __init__(self, pool_size: int):
+        self.pool_size = pool_size
+        self.compressed = 0
+        self.uncompressed = 0
+        self.baseline = (0, 0)
+        super().__init__(pool_connections=pool_size, pool_maxsize=pool_size)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + KEEPALIVE_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+    def build_response(self, req, resp) -> requests.Response:
+        if resp.headers.get("Content-Encoding"):
+            self.compressed += 1
+        else:
+            self.uncompressed += 1
+        return super().build_response(req, resp)
+
+    def reset_stats(self):
+        self.compressed = 0
+        self.uncompressed = 0
+        self.baseline = (0, 0)
+        self.baseline = self.stats()
+
+    def stats(self) -> Tuple[int, int]:
+        # connections opened and requests sent over them
+        connections = requests_sent = 0
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+        return connections - self.baseline[0], requests_sent - self.baseline[1]
+
+
+def pool_size(config: Dict) -> int:
+    # one connection for every request that can be in flight at the same time
+    workers = max(
+        config.get("property_group_workers", 4), config.get("email_events_workers", 4)
+    )
+    return config.get("http_pool_size", max(10, workers + 1))
+
+
+def create_session(config: Dict) -> requests.Session:
+    session = requests.Session()
+    adapter = TransportAdapter(pool_size(config))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # requests decodes gzip transparently, asking for it explicitly keeps it that
+    # way when proxies or session defaults change the headers
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    return session
+
+
+def endpoint_timeout(
+    config: Dict, path: str, read_timeout: float
+) -> Tuple[float, float]:
+    # (connect, read) timeouts, configured per endpoint class as
+    # {"search": [10, 300], "metadata": [5, 60]}
+    endpoint_class = "search" if any(e in path for e in SEARCH_ENDPOINTS) else "metadata"
+    timeouts = config.get("timeouts", {}).get(endpoint_class)
+    if timeouts:
+        return tuple(timeouts)
+    return config.get("connect_timeout", 10), read_timeout
+
+
+def reset_transport_stats(session: requests.Session):
+    adapter = session.get_adapter("https://")
+    if isinstance(adapter, TransportAdapter):
+        adapter.reset_stats()
+
+
+def log_transport_stats(session: requests.Session):
+    adapter = session.get_adapter("https://")
+    if not isinstance(adapter, TransportAdapter):
+        return
+    connections, requests_sent = adapter.stats()
+    if not requests_sent:
+        return
+    reuse = 1 - connections / requests_sent
+    responses = adapter.compressed + adapter.uncompressed
+    LOGGER.info(
+        f"sent {requests_sent} requests over {connections} connections ({reuse:.0%} reused), "
+        f"{adapter.compressed} of {responses} responses were compressed"
+    )
+
+
+def endpoint_template(url: str) -> str:
+    # the path with ids replaced, so requests for different objects of the same
+    # kind are counted together, e.g. /crm/v4/objects/deals/{id}/associations/contacts
+    path = urlsplit(url).path
+    return "/".join(
+        "{id}" if ID_SEGMENT.fullmatch(segment) else segment
+        for segment in path.split("/")
+    )
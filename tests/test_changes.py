@@ -0,0 +1,47 @@
+import json
+import os
+
+from tap_hubspot.changes import ChangedIds, SNAPSHOT_SUFFIX
+
+
+def write_changes(path, *ids):
+    with open(path, "w") as f:
+        for object_id in ids:
+            f.write(json.dumps({"objectType": "contacts", "objectId": object_id}) + "\n")
+
+
+def test_snapshot_left_by_failed_run_is_read_with_new_file(tmp_path):
+    path = str(tmp_path / "changes.jsonl")
+    write_changes(path + SNAPSHOT_SUFFIX, 1)
+    write_changes(path, 2)
+
+    changed_ids = ChangedIds(path)
+    assert changed_ids.ids("contacts") == ["1", "2"]
+    assert len(changed_ids.files) == 2
+
+    changed_ids.mark_processed()
+    assert sorted(name.endswith(".processed") for name in os.listdir(tmp_path)) == [True, True]
+
+
+def test_failed_runs_keep_separate_snapshots(tmp_path):
+    path = str(tmp_path / "changes.jsonl")
+    write_changes(path, 1)
+    assert ChangedIds(path).ids("contacts") == ["1"]
+
+    write_changes(path, 2)
+    changed_ids = ChangedIds(path)
+    assert changed_ids.ids("contacts") == ["1", "2"]
+    changed_ids.mark_processed()
+    assert ChangedIds.list_files(path) == []
+
+
+def test_directory_snapshots(tmp_path):
+    write_changes(tmp_path / "a.jsonl", 1)
+    changed_ids = ChangedIds(str(tmp_path))
+    assert changed_ids.ids("contacts") == ["1"]
+
+    write_changes(tmp_path / "a.jsonl", 2)
+    changed_ids = ChangedIds(str(tmp_path))
+    assert changed_ids.ids("contacts") == ["1", "2"]
+    changed_ids.mark_processed()
+    assert all(name.endswith(".processed") for name in os.listdir(tmp_path))
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from tap_hubspot.raw import RawRecord, decode_response, write_record
+
+
+def test_records_keep_their_text():
+    text = '{"results": [{"id": "1", "name": "a"} , {"id":"2"}], "paging": {"next": {"after": "2"}}}'
+    document = decode_response(text, "results")
+    assert document == json.loads(text)
+    assert [record.raw for record in document["results"]] == [
+        '{"id": "1", "name": "a"}',
+        '{"id":"2"}',
+    ]
+    assert all(isinstance(record, RawRecord) for record in document["results"])
+
+
+def test_top_level_list():
+    assert decode_response(' [{"id": 1}, 2] \n', None) == [{"id": 1}, 2]
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "   ",
+        '{"results": [{"id": "1"}',
+        '{"results": [{"id": "1"},',
+        '{"results": []',
+        '{"results"',
+        '{"results": [], }',
+        '{1: []}',
+        '{"results": []} trailing',
+        '{"results": []}{"results": []}',
+        "{} x",
+    ],
+)
+def test_invalid_documents(text):
+    with pytest.raises(ValueError):
+        decode_response(text, "results")
+
+
+@pytest.mark.parametrize("text", ["", "[1, 2", "[1 2]", "[] []"])
+def test_invalid_lists(text):
+    with pytest.raises(ValueError):
+        decode_response(text, None)
+
+
+def test_multi_line_record_is_encoded_again(capsys):
+    document = decode_response('{"results": [{"id": "1",\n "name": "a"}]}', "results")
+    write_record("owners", document["results"][0])
+    message = json.loads(capsys.readouterr().out)
+    assert message["record"] == {"id": "1", "name": "a"}
+
+
+def test_single_line_record_is_written_as_is(capsys):
+    document = decode_response('{"results": [{"name":"a",  "id":"1"}]}', "results")
+    write_record("owners", document["results"][0])
+    assert '"record": {"name":"a",  "id":"1"}}' in capsys.readouterr().out
@@ -0,0 +1,33 @@
+import pytest
+
+from tap_hubspot.shard import merge_states
+
+
+def shard_state(index, bookmark, max_id):
+    return {
+        "bookmarks": {
+            f"contacts@shard{index}of2": {"lastmodifieddate": bookmark, "shard_max_id": max_id}
+        }
+    }
+
+
+def test_merge_keeps_max_id_and_earliest_bookmark():
+    merged = merge_states(
+        [
+            shard_state(0, "2024-01-02T00:00:00Z", 200000),
+            shard_state(1, "2024-01-01T00:00:00Z", 200000),
+        ]
+    )
+    assert merged["bookmarks"] == {
+        "contacts": {"lastmodifieddate": "2024-01-01T00:00:00Z", "shard_max_id": 200000}
+    }
+
+
+def test_merge_refuses_shards_split_by_different_max_ids():
+    with pytest.raises(ValueError):
+        merge_states(
+            [
+                shard_state(0, "2024-01-02T00:00:00Z", 100000),
+                shard_state(1, "2024-01-01T00:00:00Z", 200000),
+            ]
+        )